@@ -1,15 +1,26 @@
 import os
 import uuid
-from typing import Annotated
-from fastapi import FastAPI, UploadFile, File, Header, status
+import asyncio
+from dataclasses import asdict
+from typing import Annotated, AsyncIterator, Dict, Any, Optional, get_args
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, Header, Query, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, FileResponse
+from fastapi.responses import Response, FileResponse, StreamingResponse
 
-from common.util import is_wav_media_type
+from common.cache import get_cache_stats
+from export.audio_encoder import (
+    AUDIO_ENCODINGS,
+    AudioEncoding,
+    negotiate_audio_encoding,
+)
 
 import main
 from logger import LOGGER
-from env import ENV
+from env import get_env, create_env_dirs
+from worker_pool import WORKER_POOL
+from jobs import JOB_CONSUMERS, Job, get_job_queue
+from result_cache import RESULT_CACHE
 
 
 _DESCRIPTION = """
@@ -17,7 +28,24 @@ _DESCRIPTION = """
 """
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    env = get_env()
+    create_env_dirs(env)
+    WORKER_POOL.start(size=env.WORKER_PROCESSES)
+    if not env.WARM_UP_IN_BACKGROUND:
+        WORKER_POOL.wait_until_ready()
+    if env.RUN_JOBS:
+        JOB_CONSUMERS.start(get_job_queue(), num_consumers=env.WORKER_PROCESSES)
+    try:
+        yield
+    finally:
+        await JOB_CONSUMERS.stop()
+        WORKER_POOL.shutdown()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Piranha Plants as Charade",
     summary="Music generation in the style of [_Piranha Plants on Parade_](https://www.youtube.com/watch?v=3EkzTUPoWMU).",
     description=_DESCRIPTION,
@@ -33,15 +61,102 @@ app.add_middleware(
 
 
 def authorize(token: str) -> bool:
-    return token == "Bearer " + ENV.BE_AUTH_TOKEN
+    return token == "Bearer " + get_env().BE_AUTH_TOKEN
 
 
-def generate_unique_file_name(file: UploadFile) -> str:
-    name = str(uuid.uuid4())  # UUID is guaranteed to be unique
+def generate_file_name(file: UploadFile, key: str) -> str:
     ext = ""
     if file.filename is not None:
         ext = os.path.splitext(file.filename)[1]
-    return name + ext
+    return key + ext
+
+
+def get_encoding(
+    format: Optional[str], accept: Optional[str]
+) -> Optional[AudioEncoding]:
+    """
+    Returns the requested encoding, or `None` if `format` is not an encoding.
+    """
+    if format is None:
+        return negotiate_audio_encoding(accept)
+    if format in get_args(AudioEncoding):
+        return format  # type: ignore
+    return None
+
+
+async def save_upload(file: UploadFile, encoding: AudioEncoding) -> str:
+    """
+    Saves an upload under the key of its arrangement, so identical requests share an input and an output.
+    """
+    content = await file.read()
+    upload_id = main.get_input_key(content, encoding)
+    upload_path = os.path.join(get_env().INPUT_DIR, generate_file_name(file, upload_id))
+
+    LOGGER.info(f"Handling input with ID {upload_id}")
+
+    # Save file to disk, renaming it into place so a concurrent identical request never reads it partially written.
+    if not os.path.exists(upload_path):
+        partial_path = f"{upload_path}.{uuid.uuid4()}.part"
+        with open(partial_path, "wb") as fout:
+            fout.write(content)
+        os.replace(partial_path, upload_path)
+
+    return upload_path
+
+
+def get_job_status(job: Job) -> Dict[str, Any]:
+    return {
+        "id": job.id,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": job.progress,
+        "error": job.error,
+        "attempts": job.attempts,
+    }
+
+
+@app.get(
+    "/health",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Returns whether the server is up and whether every worker has finished loading the audio sample library.",
+        },
+    },
+)
+async def health() -> Dict[str, Any]:
+    return {
+        "status": "ok",
+        "samples_loaded": WORKER_POOL.is_ready(),
+    }
+
+
+@app.get(
+    "/caches",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Returns the hit, miss and eviction counts of every cache of a worker, keyed by cache name.",
+        },
+        status.HTTP_401_UNAUTHORIZED: {
+            "description": "Requires the proper bearer token."
+        },
+    },
+)
+async def caches(
+    authorization: Annotated[
+        str,
+        Header(
+            description="A bearer token used for authorization.",
+        ),
+    ],
+) -> Any:
+    if not authorize(authorization):
+        return Response(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+        )
+    return {
+        name: {**asdict(stats), "hit_rate": stats.hit_rate}
+        for name, stats in (await WORKER_POOL.run(get_cache_stats)).items()
+    }
 
 
 @app.post(
@@ -49,9 +164,12 @@ def generate_unique_file_name(file: UploadFile) -> str:
     response_class=FileResponse,
     responses={
         status.HTTP_200_OK: {
-            "content": {"audio/wav": {}},
+            "content": {"audio/wav": {}, "audio/flac": {}, "audio/ogg": {}},
             "description": "Returns the generated arrangement in the style of _Piranha Plants on Parade_.",
         },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "The requested format is not supported."
+        },
         status.HTTP_401_UNAUTHORIZED: {
             "description": "Requires the proper bearer token."
         },
@@ -70,6 +188,24 @@ async def generate(
             description="An audio file containing a melody to arrange in the style of _Piranha Plants on Parade_."
         ),
     ],
+    format: Annotated[
+        Optional[str],
+        Query(
+            description="The encoding of the arrangement: `wav` (32-bit float), `wav16` (16-bit PCM), `flac` or `ogg`. Overrides the `Accept` header.",
+        ),
+    ] = None,
+    accept: Annotated[
+        Optional[str],
+        Header(
+            description="The preferred media types of the arrangement: `audio/wav`, `audio/flac` or `audio/ogg`.",
+        ),
+    ] = None,
+    stream: Annotated[
+        bool,
+        Query(
+            description="Whether to send the arrangement while it is being mixed. The length of streamed audio is left unknown in its header. Arrangements that were already generated are sent whole.",
+        ),
+    ] = False,
 ) -> Response:
     LOGGER.info("Requested /generate.")
 
@@ -78,23 +214,182 @@ async def generate(
             status_code=status.HTTP_401_UNAUTHORIZED,
         )
 
+    encoding = get_encoding(format, accept)
+    if encoding is None:
+        return Response(
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+
     # TODO: validate file.
 
-    upload_path = os.path.join(ENV.INPUT_DIR, generate_unique_file_name(file))
-    upload_id = os.path.splitext(os.path.basename(upload_path))[0]
+    upload_path = await save_upload(file, encoding)
 
-    LOGGER.info(f"Handling input with ID {upload_id}")
+    media_type = AUDIO_ENCODINGS[encoding].media_type
+    cached_path = RESULT_CACHE.get(upload_path, encoding)
+    if cached_path is not None:
+        return FileResponse(
+            status_code=status.HTTP_200_OK,
+            path=cached_path,
+            media_type=media_type,
+        )
 
-    # Save file to disk.
-    with open(upload_path, "wb") as fout:
-        content = await file.read()
-        fout.write(content)
+    if stream:
+        chunks = await WORKER_POOL.stream(main.generate_stream, upload_path, encoding)
+        return StreamingResponse(
+            chunks,
+            status_code=status.HTTP_200_OK,
+            media_type=media_type,
+        )
 
-    output_path = await main.generate(input_path=upload_path)
-    assert is_wav_media_type(output_path)
+    output_path = await RESULT_CACHE.get_or_generate(
+        upload_path,
+        encoding,
+        lambda: WORKER_POOL.run(main.generate, upload_path, encoding),
+    )
 
     return FileResponse(
         status_code=status.HTTP_200_OK,
         path=output_path,
-        media_type="audio/wav",
+        media_type=media_type,
+    )
+
+
+@app.post(
+    "/jobs",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={
+        status.HTTP_202_ACCEPTED: {
+            "description": "Queues the arrangement of the input, and returns the status of its job. Poll `/jobs/{job_id}` until the job finishes.",
+        },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "The requested format is not supported."
+        },
+        status.HTTP_401_UNAUTHORIZED: {
+            "description": "Requires the proper bearer token."
+        },
+    },
+)
+async def submit_job(
+    authorization: Annotated[
+        str,
+        Header(
+            description="A bearer token used for authorization.",
+        ),
+    ],
+    file: Annotated[
+        UploadFile,
+        File(
+            description="An audio file containing a melody to arrange in the style of _Piranha Plants on Parade_."
+        ),
+    ],
+    format: Annotated[
+        Optional[str],
+        Query(
+            description="The encoding of the arrangement: `wav` (32-bit float), `wav16` (16-bit PCM), `flac` or `ogg`. Overrides the `Accept` header.",
+        ),
+    ] = None,
+    accept: Annotated[
+        Optional[str],
+        Header(
+            description="The preferred media types of the arrangement: `audio/wav`, `audio/flac` or `audio/ogg`.",
+        ),
+    ] = None,
+) -> Any:
+    LOGGER.info("Requested /jobs.")
+
+    if not authorize(authorization):
+        return Response(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+        )
+
+    encoding = get_encoding(format, accept)
+    if encoding is None:
+        return Response(
+            status_code=status.HTTP_400_BAD_REQUEST,
+        )
+
+    # TODO: validate file.
+
+    upload_path = await save_upload(file, encoding)
+    job = await asyncio.to_thread(get_job_queue().submit, upload_path, encoding)
+    return get_job_status(job)
+
+
+@app.get(
+    "/jobs/{job_id}",
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Returns the status of a job: `queued`, `running`, `succeeded` or `failed`, with the stage being run, the fraction of stages finished, the error of the last failed attempt, and the number of attempts. Failed attempts are retried.",
+        },
+        status.HTTP_401_UNAUTHORIZED: {
+            "description": "Requires the proper bearer token."
+        },
+        status.HTTP_404_NOT_FOUND: {"description": "The job does not exist."},
+    },
+)
+async def get_job(
+    authorization: Annotated[
+        str,
+        Header(
+            description="A bearer token used for authorization.",
+        ),
+    ],
+    job_id: str,
+) -> Any:
+    if not authorize(authorization):
+        return Response(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+        )
+
+    job = await asyncio.to_thread(get_job_queue().get, job_id)
+    if job is None:
+        return Response(
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    return get_job_status(job)
+
+
+@app.get(
+    "/jobs/{job_id}/result",
+    response_class=FileResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"audio/wav": {}, "audio/flac": {}, "audio/ogg": {}},
+            "description": "Returns the arrangement generated by a succeeded job.",
+        },
+        status.HTTP_401_UNAUTHORIZED: {
+            "description": "Requires the proper bearer token."
+        },
+        status.HTTP_404_NOT_FOUND: {"description": "The job does not exist."},
+        status.HTTP_409_CONFLICT: {"description": "The job has not succeeded."},
+    },
+)
+async def get_job_result(
+    authorization: Annotated[
+        str,
+        Header(
+            description="A bearer token used for authorization.",
+        ),
+    ],
+    job_id: str,
+) -> Response:
+    if not authorize(authorization):
+        return Response(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+        )
+
+    job = await asyncio.to_thread(get_job_queue().get, job_id)
+    if job is None:
+        return Response(
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    if job.output_path is None:
+        return Response(
+            status_code=status.HTTP_409_CONFLICT,
+        )
+
+    return FileResponse(
+        status_code=status.HTTP_200_OK,
+        path=job.output_path,
+        media_type=AUDIO_ENCODINGS[job.encoding].media_type,
     )
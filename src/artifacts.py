@@ -0,0 +1,47 @@
+import os
+import uuid
+import numpy as np
+from functools import cache
+from typing import Dict, Optional
+from numpy.typing import NDArray
+
+from env import get_env
+
+
+class ArtifactStore:
+    """
+    Persists the output of each stage of the pipeline as NumPy arrays in a directory, keyed by a hash of the inputs of the stage.
+
+    :param directory: The directory of the artifacts.
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    def load(self, stage: str, key: str) -> Optional[Dict[str, NDArray[np.generic]]]:
+        path = self._get_path(stage, key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as artifact:
+            return dict(artifact)
+
+    def save(self, stage: str, key: str, arrays: Dict[str, NDArray[np.generic]]):
+        path = self._get_path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Save next to the artifact and rename it, so a partially written artifact is never loaded.
+        partial_path = f"{path}.{uuid.uuid4()}.part"
+        with open(partial_path, "wb") as fout:
+            np.savez_compressed(fout, **arrays)
+        os.replace(partial_path, path)
+
+    def _get_path(self, stage: str, key: str) -> str:
+        return os.path.join(self._directory, stage.replace(" ", "_"), f"{key}.npz")
+
+
+@cache
+def get_artifact_store() -> ArtifactStore:
+    """
+    Opens the artifact store of the environment on first call.
+    """
+    env = get_env()
+    return ArtifactStore(env.ARTIFACT_DIR or os.path.join(env.OUTPUT_DIR, "artifacts"))
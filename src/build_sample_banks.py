@@ -0,0 +1,19 @@
+from common.audio_sample import (
+    AudioSampleCollection,
+    list_collection_names,
+    load_collection_config,
+)
+
+
+def build_sample_banks():
+    for sample_name in list_collection_names():
+        collection = AudioSampleCollection(
+            load_collection_config(sample_name),
+            use_bank=False,
+        )
+        collection.save_bank()
+        print(f"Built the sample bank for {sample_name}.")
+
+
+if __name__ == "__main__":
+    build_sample_banks()
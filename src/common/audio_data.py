@@ -1,89 +1,176 @@
 import librosa
 import numpy as np
 import scipy.signal  # type: ignore
-from typing import DefaultDict, Dict, Tuple, Any
+from typing import Tuple, Any
 from numpy.typing import NDArray
-from collections import defaultdict
-from functools import cached_property
 
 from common.util import db_to_strength
 
 
 class AudioData:
+    """
+    Mono audio backed by a growable, contiguous float32 buffer.
+
+    Frames that were never written read as silence. The buffer grows geometrically, so appending past the end is amortized O(1) per frame. `pad_start` only records an offset; the leading silence is materialized the next time the buffer is read as a whole or written before the offset.
+
+    Slices share their parent's buffer. A buffer that is shared is copied by whichever side writes to it first.
+    """
+
+    _GROWTH_FACTOR = 1.5
 
     def __init__(
         self,
         init_data: NDArray[np.float32] = np.array([]),
         sample_rate: float = 44100,
     ):
-        self._data: DefaultDict[int, np.float32] = defaultdict(lambda: np.float32(0))
+        self._buffer: NDArray[np.float32] = np.array(init_data, dtype=np.float32)
+        self._length: int = len(self._buffer)  # number of frames in use
+        self._offset: int = 0  # number of leading silent frames not in `_buffer`
+        self._shared: bool = False  # whether `_buffer` may be referenced elsewhere
         self._sample_rate: float = sample_rate
-        self.set_range((0, len(init_data)), init_data)
 
     @classmethod
-    def from_file(cls, file_name: str, sample_rate: float | None = None, db: float = 0):
+    def from_buffer(
+        cls,
+        buffer: NDArray[np.float32],
+        sample_rate: float = 44100,
+        shared: bool = True,
+    ) -> "AudioData":
+        """
+        Wraps `buffer` without copying it.
+
+        :param buffer: The audio frames.
+        :param sample_rate: The sample rate of the audio.
+        :param shared: Whether `buffer` may be referenced elsewhere. A shared buffer is copied before it is first written to.
+        """
+        assert buffer.dtype == np.float32 and buffer.ndim == 1
+        self = cls(sample_rate=sample_rate)
+        self._buffer = buffer
+        self._length = len(buffer)
+        self._shared = shared
+        return self
+
+    @classmethod
+    def from_file(
+        cls,
+        file_name: str,
+        sample_rate: float | None = None,
+        db: float = 0,
+        offset: float = 0,
+        duration: float | None = None,
+    ):
         signal: NDArray[np.float32]
 
         signal, sr = librosa.load(  # type: ignore
             file_name,
             sr=sample_rate,
             dtype=np.float32,
+            offset=offset,
+            duration=duration,
         )
 
         signal *= db_to_strength(db)
-        return cls(signal, sr)
+        return cls.from_buffer(signal, sr, shared=False)
 
-    @cached_property
+    @property
     def array(self) -> NDArray[np.float32]:
-        keys = self._data.keys()
-        if len(keys) == 0:
-            return np.array([])
-        return np.array([self._data[i] for i in range(max(keys) + 1)])
+        """
+        A view of the audio. The view is invalidated by any write that grows the buffer.
+        """
+        self._materialize_offset()
+        return self._buffer[: self._length]
 
     @property
     def sample_rate(self) -> float:
         return self._sample_rate
 
+    def __len__(self) -> int:
+        return self._offset + self._length
+
     def slice(self, start: int, end: int) -> "AudioData":
-        return AudioData(self.array[start:end])
+        """
+        Returns frames `[start, end)` as a view that shares this audio's buffer.
+        """
+        start, end, _ = slice(start, end).indices(len(self))
+        end = max(start, end)
+        view = AudioData(sample_rate=self.sample_rate)
+        view._offset = max(min(self._offset, end) - start, 0)
+        buffer_start = max(start - self._offset, 0)
+        buffer_end = min(max(end - self._offset, 0), self._length)
+        view._buffer = self._buffer[buffer_start:buffer_end]
+        view._length = len(view._buffer)
+        view._shared = self._shared = True
+        return view
 
     def at(self, idx: int) -> np.float32:
-        return self._data[idx]
+        idx -= self._offset
+        if not 0 <= idx < self._length:
+            return np.float32(0)
+        return self._buffer[idx]
 
     def set(self, idx: int, val: np.float32):
         assert idx >= 0
-        self._data[idx] = val
-        self._clear_array_cache()
+        self.set_range((idx, idx + 1), np.array([val], dtype=np.float32))
 
     def set_range(self, r: Tuple[int, int], vals: NDArray[np.float32]):
         assert r[1] - r[0] == len(vals)
-        update = {r[0] + i: v for i, v in enumerate(vals)}
-        self._data.update(update)
-        self._clear_array_cache()
+        start, end = self._prepare_range(r)
+        self._buffer[start:end] = vals
 
     def add(self, idx: int, val: np.float32):
         self.set(idx, self.at(idx) + val)
 
     def add_range(self, r: Tuple[int, int], vals: NDArray[np.float32]):
         assert r[1] - r[0] == len(vals)
-        self.set_range(r, np.array([self.at(i) for i in range(*r)]) + vals)
+        start, end = self._prepare_range(r)
+        self._buffer[start:end] += vals
 
     def pad_start(self, n: int):
-        new_dict: Dict[int, np.float32] = dict()
-        for key, val in self._data.items():
-            new_dict[key + n] = val
-        self._data = defaultdict(lambda: np.float32(0), new_dict)
-        self._clear_array_cache()
+        self._offset += n
 
     def apply_filter(self, filt: Any) -> "AudioData":  # TODO: type `filt` properly
-        self = AudioData(
-            init_data=scipy.signal.lfilter(*filt, self.array).astype(np.float32),  # type: ignore
+        self = AudioData.from_buffer(
+            scipy.signal.lfilter(*filt, self.array).astype(np.float32),  # type: ignore
             sample_rate=self.sample_rate,
+            shared=False,
         )
         return self
 
-    def _clear_array_cache(self):
-        try:
-            del self.array
-        except:
-            pass
+    def _prepare_range(self, r: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        Makes the buffer cover the frame range `r` and returns the range as buffer indices.
+        """
+        assert r[0] >= 0
+        if r[0] < self._offset:
+            self._materialize_offset()
+        start, end = r[0] - self._offset, r[1] - self._offset
+        self._reserve(end)
+        if self._shared:
+            self._buffer = self._buffer.copy()
+            self._shared = False
+        self._length = max(self._length, end)
+        return start, end
+
+    def _reserve(self, capacity: int):
+        if capacity <= len(self._buffer):
+            return
+        new_capacity = max(capacity, int(len(self._buffer) * self._GROWTH_FACTOR))
+        buffer = np.zeros(new_capacity, dtype=np.float32)
+        buffer[: self._length] = self._buffer[: self._length]
+        self._buffer = buffer
+        self._shared = False
+
+    def _materialize_offset(self):
+        if self._offset == 0:
+            return
+        buffer = np.zeros(
+            max(len(self._buffer), self._offset + self._length),
+            dtype=np.float32,
+        )
+        buffer[self._offset : self._offset + self._length] = self._buffer[
+            : self._length
+        ]
+        self._buffer = buffer
+        self._length += self._offset
+        self._offset = 0
+        self._shared = False
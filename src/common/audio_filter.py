@@ -0,0 +1,56 @@
+import numpy as np
+import scipy.signal  # type: ignore
+from typing import List, Literal
+from numpy.typing import NDArray
+
+from common.cache import memoize
+
+
+FilterType = Literal["lowpass", "highpass"]
+
+
+@memoize("audio_filter.designs", maxsize=1024)
+def design_butterworth_filter(
+    order: int,
+    cutoff: float,
+    sample_rate: float,
+    btype: FilterType = "lowpass",
+) -> NDArray[np.float64]:
+    """
+    Designs a Butterworth filter as second-order sections. Designs are cached, so equal arguments return the same array.
+
+    :param order: The order of the filter.
+    :param cutoff: The cutoff frequency in Hz.
+    :param sample_rate: The sample rate of the signals to filter.
+    :param btype: The type of filter.
+    """
+    sos: NDArray[np.float64] = scipy.signal.butter(  # type: ignore
+        order,
+        cutoff / (sample_rate / 2),
+        btype=btype,
+        output="sos",
+    )
+    sos.setflags(write=False)
+    return sos
+
+
+def filter_signals(
+    signals: List[NDArray[np.float32]],
+    designs: List[NDArray[np.float64]],
+) -> List[NDArray[np.float32]]:
+    """
+    Filters each signal with its filter design.
+
+    :param signals: The signals to filter.
+    :param designs: The second-order sections to filter each signal with.
+    """
+    assert len(signals) == len(designs)
+    return [
+        # `sosfilt` cannot filter a signal without frames, and requires a writable design.
+        (
+            scipy.signal.sosfilt(design.copy(), signal).astype(np.float32)  # type: ignore
+            if len(signal) > 0
+            else np.zeros(0, dtype=np.float32)
+        )
+        for signal, design in zip(signals, designs)
+    ]
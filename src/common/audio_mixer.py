@@ -0,0 +1,188 @@
+import numpy as np
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from typing import Callable, Iterator, Optional, Sequence
+from numpy.typing import NDArray
+
+
+def get_mix_length(start_frames: NDArray[np.int64], lengths: NDArray[np.int64]) -> int:
+    """
+    Returns the number of frames needed to hold every waveform of an overlap-add.
+
+    :param start_frames: The frame at which each waveform starts.
+    :param lengths: The number of frames in each waveform.
+    """
+    if len(start_frames) == 0:
+        return 0
+    return max(int(np.max(start_frames + lengths)), 0)
+
+
+def overlap_add(
+    output: NDArray[np.float32],
+    start_frames: NDArray[np.int64],
+    waveforms: Sequence[NDArray[np.float32]],
+) -> NDArray[np.float32]:
+    """
+    Mixes each waveform into `output` in place, starting at its start frame. Frames that fall outside of `output` are dropped.
+
+    :param output: The preallocated buffer to mix into.
+    :param start_frames: The frame at which each waveform starts.
+    :param waveforms: The waveforms to mix.
+    :return: `output`.
+    """
+    assert len(start_frames) == len(waveforms)
+    ends = np.minimum(start_frames + [len(w) for w in waveforms], len(output))
+    starts = np.maximum(start_frames, 0)
+    for i, waveform in enumerate(waveforms):
+        start, end = int(starts[i]), int(ends[i])
+        if start >= end:
+            continue
+        offset = start - int(start_frames[i])
+        output[start:end] += waveform[offset : offset + end - start]
+    return output
+
+
+class AudioSource(ABC):
+    """
+    Audio that is rendered in blocks of frames, so that it never has to be held in memory at once.
+    """
+
+    @abstractmethod
+    def render(self, start: int, end: int) -> NDArray[np.float32]:
+        """
+        Renders frames `[start, end)`. Fewer frames are returned if the audio ends before `end`.
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class OverlapAddSource(AudioSource):
+    """
+    Waveforms mixed at their start frames, rendered block by block. Blocks can be rendered in any order.
+
+    :param start_frames: The frame at which each waveform starts.
+    :param lengths: The number of frames in each waveform.
+    :param get_waveform: Returns the waveform at an index. Only called for the waveforms that overlap a rendered block.
+    :param gain: The gain applied to the mix.
+    """
+
+    def __init__(
+        self,
+        start_frames: NDArray[np.int64],
+        lengths: NDArray[np.int64],
+        get_waveform: Callable[[int], NDArray[np.float32]],
+        gain: float = 1,
+    ):
+        assert len(start_frames) == len(lengths)
+        self._start_frames = start_frames
+        self._end_frames = start_frames + lengths
+        self._get_waveform = get_waveform
+        self._gain = gain
+        self._num_frames = get_mix_length(start_frames, lengths)
+
+    @property
+    def num_frames(self) -> int:
+        return self._num_frames
+
+    def render(self, start: int, end: int) -> NDArray[np.float32]:
+        end = min(end, self._num_frames)
+        if start >= end:
+            return np.zeros(0, dtype=np.float32)
+        output = np.zeros(end - start, dtype=np.float32)
+        overlapping = np.flatnonzero(
+            (self._start_frames < end) & (self._end_frames > start)
+        )
+        overlap_add(
+            output,
+            self._start_frames[overlapping] - start,
+            [self._get_waveform(int(i)) for i in overlapping],
+        )
+        if self._gain != 1:
+            output *= self._gain
+        return output
+
+
+class StreamSource(AudioSource):
+    """
+    Audio produced in chunks of any size, such as the output of a subprocess. Blocks must be rendered in increasing order, since rendered frames are dropped.
+
+    :param chunks: The consecutive chunks of the audio.
+    :param start_frame: The frame at which the audio starts. Earlier frames are silent.
+    """
+
+    def __init__(self, chunks: Iterator[NDArray[np.float32]], start_frame: int = 0):
+        self._chunks = chunks
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._buffer_start = start_frame  # the frame of the first buffered sample
+        self._exhausted = False
+
+    def render(self, start: int, end: int) -> NDArray[np.float32]:
+        assert start >= self._buffer_start or len(self._buffer) == 0
+        pieces = [self._buffer]
+        buffer_end = self._buffer_start + len(self._buffer)
+        while buffer_end < end and not self._exhausted:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._exhausted = True
+                break
+            pieces.append(chunk)
+            buffer_end += len(chunk)
+        buffer = np.concatenate(pieces) if len(pieces) > 1 else self._buffer
+
+        stop = min(end, buffer_end)
+        if stop <= start:
+            self._buffer = buffer
+            return np.zeros(0, dtype=np.float32)
+        output = np.zeros(stop - start, dtype=np.float32)
+        first = max(start, self._buffer_start)
+        output[first - start :] = buffer[
+            first - self._buffer_start : stop - self._buffer_start
+        ]
+
+        # Drop the rendered frames.
+        dropped = max(stop - self._buffer_start, 0)
+        self._buffer = buffer[dropped:]
+        self._buffer_start += dropped
+        return output
+
+    def close(self):
+        close = getattr(self._chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def mix_blocks(
+    sources: Sequence[AudioSource],
+    block_size: int,
+    executor: Optional[Executor] = None,
+) -> Iterator[NDArray[np.float32]]:
+    """
+    Yields the sum of the sources block by block, until every source has ended. Only one block of each source is held at a time.
+
+    :param sources: The sources to mix, summed in order.
+    :param block_size: The number of frames in each block. The last block may be shorter.
+    :param executor: Renders the sources of a block concurrently, if set.
+    """
+    start = 0
+    while True:
+        end = start + block_size
+
+        def render(source: AudioSource) -> NDArray[np.float32]:
+            return source.render(start, end)
+
+        if executor is not None:
+            blocks = list(executor.map(render, sources))
+        else:
+            blocks = [render(source) for source in sources]
+        length = max((len(block) for block in blocks), default=0)
+        if length == 0:
+            return
+        output = np.zeros(length, dtype=np.float32)
+        for block in blocks:
+            output[: len(block)] += block
+        yield output
+        if length < block_size:
+            return
+        start = end
@@ -1,32 +1,46 @@
 import os
-import random
+import threading
 import librosa
-import scipy.signal  # type: ignore
 import numpy as np
-from dataclasses import dataclass
-from typing import Tuple, Dict, Optional, Callable
+from dataclasses import dataclass, asdict
+from typing import Tuple, Dict, List, Literal, Callable, Any
 from numpy.typing import NDArray
-from functools import cache
 
 from common.util import is_wav_media_type
+from common.cache import CacheStats, LRUCache, memoize
 from common.audio_data import AudioData
+from common.audio_filter import design_butterworth_filter, filter_signals
+from common.sample_bank import (
+    SAMPLE_BANK_EXTENSION,
+    InvalidSampleBank,
+    read_sample_bank,
+    write_sample_bank,
+)
 from common.structures.pitch import Pitch
 
 from env import load_env
 
 
-FilterFn = Callable[[AudioData, float], AudioData]
+SampleStorage = Literal["float32", "float16", "int16"]
+
+
+# Filters a batch of signals, given the pitch of each signal in Hz and the sample rate.
+FilterFn = Callable[
+    [List[NDArray[np.float32]], List[float], float],
+    List[NDArray[np.float32]],
+]
 
 
 SAMPLES_DIR = "../data/samples"
+NOTE_WAVEFORM_CACHE_BYTES = 128 * 2**20
 FILTER_FNS: Dict[str, FilterFn] = {
-    "none": lambda data, pitch: data,
-    "voice": lambda data, pitch: data.apply_filter(
-        scipy.signal.butter(  # type: ignore
-            1,
-            pitch * 9 / (data.sample_rate / 2),
-            btype="lowpass",
-        )
+    "none": lambda signals, pitches, sample_rate: signals,
+    "voice": lambda signals, pitches, sample_rate: filter_signals(
+        signals,
+        [
+            design_butterworth_filter(1, pitch * 9, sample_rate, btype="lowpass")
+            for pitch in pitches
+        ],
     ),
 }
 
@@ -54,6 +68,20 @@ class AudioSampleCollectionConfig:
         assert self.filter_type in FILTER_FNS
         return FILTER_FNS[self.filter_type]
 
+    @property
+    def source_dir(self) -> str:
+        return os.path.join(SAMPLES_DIR, self.name)
+
+    @property
+    def bank_path(self) -> str:
+        return os.path.join(SAMPLES_DIR, self.name + SAMPLE_BANK_EXTENSION)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            **asdict(self),
+            "range": [pitch.value for pitch in self.range],
+        }
+
 
 @dataclass(frozen=True)
 class AudioSampleTimbreProperties:
@@ -73,7 +101,7 @@ class AudioSampleTimbreProperties:
     ease_out_factor: float = 0.1
     db: float = 0
 
-    @cache
+    @memoize("audio_sample.envelopes", max_bytes=32 * 2**20)
     def get_envelope(self, num_samples: int) -> NDArray[np.float32]:
         num_ease_in_samples = int(num_samples * self.ease_in_factor)
         num_ease_out_samples = int(num_samples * self.ease_out_factor)
@@ -81,32 +109,132 @@ class AudioSampleTimbreProperties:
         window_start = np.hamming(num_ease_in_samples * 2)[:num_ease_in_samples]
         window_end = np.hamming(num_ease_out_samples * 2)[num_ease_out_samples:]
         window_middle = np.ones(num_samples - len(window_start) - len(window_end))
-        return np.concatenate(
+        envelope = np.concatenate(
             [window_start, window_middle, window_end],
             dtype=np.float32,
         )
+        envelope.setflags(write=False)  # shared by every caller
+        return envelope
 
 
 @dataclass(frozen=True)
 class AudioSample:
-    audio: AudioData
+    """
+    :param frames: The frames of the sample, stored as float32, float16 or int16.
+    :param scale: The factor that converts the stored frames to amplitudes.
+    :param sample_rate: The sample rate of the frames.
+    :param timbre_properties: The properties of the sample's timbre.
+    """
+
+    frames: NDArray[Any]
+    scale: float
+    sample_rate: float
     timbre_properties: AudioSampleTimbreProperties
 
+    @classmethod
+    def from_signal(
+        cls,
+        signal: NDArray[np.float32],
+        sample_rate: float,
+        timbre_properties: AudioSampleTimbreProperties,
+        storage: SampleStorage = "float32",
+    ) -> "AudioSample":
+        """
+        :param signal: The frames of the sample. Stored without copying if `storage` is float32.
+        :param storage: The type in which the frames are stored. int16 frames are scaled by the sample's peak.
+        """
+        frames: NDArray[Any] = signal
+        scale = 1.0
+        match storage:
+            case "float32":
+                pass
+            case "float16":
+                frames = signal.astype(np.float16)
+            case "int16":
+                peak = float(np.max(np.abs(signal), initial=0))
+                scale = peak / np.iinfo(np.int16).max if peak > 0 else 1.0
+                frames = np.round(signal / scale).astype(np.int16)
+        return cls(
+            frames=frames,
+            scale=scale,
+            sample_rate=sample_rate,
+            timbre_properties=timbre_properties,
+        )
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    @property
+    def audio(self) -> AudioData:
+        """
+        The whole sample as audio. Dequantizes the sample unless it is stored as float32.
+        """
+        return AudioData.from_buffer(self.read(len(self)), self.sample_rate)
+
+    def read(self, num_frames: int, gain: float = 1) -> NDArray[np.float32]:
+        """
+        Returns the first `num_frames` frames as amplitudes scaled by `gain`. Only these frames are dequantized.
+        """
+        frames = self.frames[:num_frames]
+        factor = np.float32(self.scale * gain)
+        if frames.dtype == np.float32 and factor == 1:
+            return frames
+        return frames * factor
+
 
 class SkipFileOnSampleLoad(Exception):
     pass
 
 
+_NOTE_WAVEFORM_CACHE: LRUCache[
+    Tuple[str, SampleStorage, str, Pitch, int, float],
+    NDArray[np.float32] | None,
+] = LRUCache("audio_sample.note_waveforms", max_bytes=NOTE_WAVEFORM_CACHE_BYTES)
+
+
 class AudioSampleCollection:
+    """
+    :param config: The collection configuration.
+    :param use_bank: Whether to memory-map the prebuilt sample bank instead of decoding the sample files, if the bank is up to date.
+    :param lazy: Whether to decode each pitch from the sample files on first use instead of decoding every pitch upfront. Ignored if the sample bank is loaded.
+    :param cache_size: The maximum number of lazily decoded pitches kept in memory.
+    :param storage: The type in which the sample frames are kept in memory. Compact types are dequantized per rendered note.
+    """
 
-    def __init__(self, config: AudioSampleCollectionConfig):
+    def __init__(
+        self,
+        config: AudioSampleCollectionConfig,
+        use_bank: bool = True,
+        lazy: bool = False,
+        cache_size: int = 64,
+        storage: SampleStorage = "float32",
+    ):
         self._sample_data: Dict[Tuple[str, Pitch], AudioSample] = dict()
         self._timbre_data: Dict[str, AudioSampleTimbreProperties] = dict()
+        self._timbre_files: Dict[str, str] = dict()
+        self._timbre_durations: Dict[str, float] = dict()  # in seconds
+        self._sample_cache: LRUCache[Tuple[str, Pitch], AudioSample] = LRUCache(
+            f"audio_sample_collection.{config.name}",
+            maxsize=cache_size,
+        )
         self._config = config
-        for timbre_file in os.listdir(os.path.join(SAMPLES_DIR, self._config.name)):
+        self._storage: SampleStorage = storage
+        self._lazy = False
+        if use_bank and self._is_bank_current():
+            try:
+                self._load_bank()
+            except (InvalidSampleBank, OSError, ValueError, KeyError):
+                print(f"Failed to load {self._config.bank_path}.")
+                self._sample_data.clear()
+                self._timbre_data.clear()
+            else:
+                print(f"Loaded {self._config.bank_path}.")
+                return
+        self._lazy = lazy
+        for timbre_file in os.listdir(self._config.source_dir):
             try:
                 self._load_timbre_file(
-                    os.path.join(SAMPLES_DIR, self._config.name, timbre_file)
+                    os.path.join(self._config.source_dir, timbre_file)
                 )
             except SkipFileOnSampleLoad:
                 pass
@@ -125,59 +253,266 @@ class AudioSampleCollection:
             os.path.join(dir, f"{timbre}.timbre"),
         )
         self._timbre_data[timbre] = timbre_properties
+        self._timbre_files[timbre] = path
+        if self._lazy:
+            self._timbre_durations[timbre] = librosa.get_duration(path=path)  # type: ignore
+            return
         # throws an exception if load failed
         audio = AudioData.from_file(
             path,
             sample_rate=self.sample_rate,
             db=timbre_properties.db,
         )
+        pitches = [
+            Pitch(pitch_value)
+            for pitch_value in range(
+                self._config.range[0].value, self._config.range[1].value + 1
+            )
+        ]
+        samples = self._create_samples(
+            timbre,
+            pitches,
+            [audio.slice(*self._get_frame_range(timbre, pitch)) for pitch in pitches],
+        )
+        for pitch, sample in zip(pitches, samples):
+            self._sample_data[(timbre, pitch)] = sample
 
-        def splice_audio(index: int) -> AudioData:
-            def to_frame(position: float) -> int:
-                m = self.sample_rate * 60 / self._config.beats_per_minute
-                return int(m * position)
+    def _load_sample(self, timbre: str, pitch: Pitch) -> AudioSample:
+        """
+        Decodes only the frames of a single pitch from its sample file.
+        """
+        start, end = self._get_frame_range(timbre, pitch)
+        audio = AudioData(sample_rate=self.sample_rate)
+        if start / self.sample_rate < self._timbre_durations[timbre]:
+            audio = AudioData.from_file(
+                self._timbre_files[timbre],
+                sample_rate=self.sample_rate,
+                db=self._timbre_data[timbre].db,
+                offset=start / self.sample_rate,
+                duration=(end - start) / self.sample_rate,
+            )
+        return self._create_samples(timbre, [pitch], [audio.slice(0, end - start)])[0]
 
-            frame = to_frame(index)
-            return audio.slice(
-                frame + timbre_properties.start_frame,
-                frame + timbre_properties.end_frame,
+    def _get_frame_range(self, timbre: str, pitch: Pitch) -> Tuple[int, int]:
+        """
+        Returns the range of frames of a pitch in its sample file.
+        """
+        timbre_properties = self._timbre_data[timbre]
+        index = pitch.value - self._config.range[0].value
+        m = self.sample_rate * 60 / self._config.beats_per_minute
+        frame = int(m * index)
+        return (
+            frame + timbre_properties.start_frame,
+            frame + timbre_properties.end_frame,
+        )
+
+    def _create_samples(
+        self,
+        timbre: str,
+        pitches: List[Pitch],
+        audios: List[AudioData],
+    ) -> List[AudioSample]:
+        """
+        Filters the audio of each pitch of a timbre in one batch.
+        """
+        signals = self._config.filter_fn(
+            [audio.array for audio in audios],
+            [float(librosa.midi_to_hz(pitch.value)) for pitch in pitches],  # type: ignore
+            self.sample_rate,
+        )
+        return [
+            AudioSample.from_signal(
+                signal,
+                self.sample_rate,
+                self._timbre_data[timbre],
+                storage=self._storage,
             )
+            for signal in signals
+        ]
 
-        for i, pitch_value in enumerate(
-            range(self._config.range[0].value, self._config.range[1].value + 1)
-        ):
-            self._sample_data[(timbre, Pitch(pitch_value))] = AudioSample(
-                audio=self._config.filter_fn(
-                    splice_audio(i),
-                    float(librosa.midi_to_hz(pitch_value)),  # type: ignore
-                ),
-                timbre_properties=timbre_properties,
+    def save_bank(self):
+        """
+        Writes the processed samples to the collection's sample bank.
+        """
+        assert not self._lazy, "Cannot save a lazily loaded collection."
+        write_sample_bank(
+            self._config.bank_path,
+            {
+                "config": self._config.to_json(),
+                "timbres": {
+                    timbre: asdict(properties)
+                    for timbre, properties in self._timbre_data.items()
+                },
+            },
+            {
+                (timbre, pitch.value): sample.read(len(sample))
+                for (timbre, pitch), sample in self._sample_data.items()
+            },
+        )
+
+    def _is_bank_current(self) -> bool:
+        """
+        Whether the sample bank exists and is newer than every file in the collection folder.
+        """
+        if not os.path.exists(self._config.bank_path):
+            return False
+        bank_time = os.path.getmtime(self._config.bank_path)
+        return all(
+            os.path.getmtime(os.path.join(self._config.source_dir, file_name))
+            <= bank_time
+            for file_name in os.listdir(self._config.source_dir)
+        )
+
+    def _load_bank(self):
+        metadata, signals = read_sample_bank(self._config.bank_path)
+        if metadata["config"] != self._config.to_json():
+            raise InvalidSampleBank("The sample bank was built with another config.")
+        for timbre, properties in metadata["timbres"].items():
+            self._timbre_data[timbre] = AudioSampleTimbreProperties(**properties)
+        for (timbre, pitch_value), signal in signals.items():
+            self._sample_data[(timbre, Pitch(pitch_value))] = AudioSample.from_signal(
+                signal,
+                self.sample_rate,
+                self._timbre_data[timbre],
+                storage=self._storage,
             )
 
     @property
     def sample_rate(self) -> int:
         return self._config.sample_rate
 
+    @property
+    def cache_stats(self) -> CacheStats:
+        return self._sample_cache.stats
+
     def get_sample(self, timbre: str, pitch: Pitch) -> AudioSample | None:
         query = (timbre, pitch)
+        if self._lazy:
+            if timbre not in self._timbre_files or not (
+                self._config.range[0].value
+                <= pitch.value
+                <= self._config.range[1].value
+            ):
+                return None
+            return self._sample_cache.get_or_create(
+                query,
+                lambda: self._load_sample(timbre, pitch),
+            )
         if query not in self._sample_data:
             return None
         return self._sample_data[query]
 
-    def get_random_timbre(self, seed: Optional[int] = None) -> str:
-        random.seed(seed)
-        return random.choice(list(self._timbre_data.keys()))
+    def get_note_waveform(
+        self,
+        timbre: str,
+        pitch: Pitch,
+        num_frames: int,
+        gain: float,
+    ) -> NDArray[np.float32] | None:
+        """
+        Returns the first `num_frames` frames of a sample, scaled by `gain` and shaped by the timbre's envelope. Waveforms are cached across parts and requests, so the returned array is read-only.
+        """
 
+        def create() -> NDArray[np.float32] | None:
+            sample = self.get_sample(timbre, pitch)
+            if sample is None:
+                return None
+            waveform = sample.read(
+                num_frames, gain
+            ) * sample.timbre_properties.get_envelope(num_frames)
+            waveform.setflags(write=False)
+            return waveform
 
-AUDIO_SAMPLE_LIBRARY = {
-    sample_name: AudioSampleCollection(
-        load_env(
-            AudioSampleCollectionConfig,
-            os.path.join(SAMPLES_DIR, sample_name, ".config"),
-            default_args={"name": sample_name},
-        ),
+        return _NOTE_WAVEFORM_CACHE.get_or_create(
+            # Compact storage changes the frames, so collections stored differently do not share waveforms.
+            (self._config.name, self._storage, timbre, pitch, num_frames, gain),
+            create,
+        )
+
+    @property
+    def timbres(self) -> List[str]:
+        return sorted(self._timbre_data.keys())
+
+    def get_random_timbres(self, count: int, rng: np.random.Generator) -> List[str]:
+        """
+        Draws `count` timbres uniformly at random. Generators in the same state draw the same timbres.
+        """
+        timbres = self.timbres
+        if len(timbres) == 0:
+            return list()
+        return [timbres[i] for i in rng.integers(len(timbres), size=count)]
+
+
+def load_collection_config(sample_name: str) -> AudioSampleCollectionConfig:
+    return load_env(
+        AudioSampleCollectionConfig,
+        os.path.join(SAMPLES_DIR, sample_name, ".config"),
+        default_args={"name": sample_name},
     )
-    for sample_name in os.listdir(SAMPLES_DIR)
-    if os.path.isdir(os.path.join(SAMPLES_DIR, sample_name))
-}
-print(f"Loaded audio samples from {list(AUDIO_SAMPLE_LIBRARY.keys())}.")
+
+
+def list_collection_names() -> List[str]:
+    return [
+        sample_name
+        for sample_name in os.listdir(SAMPLES_DIR)
+        if os.path.isdir(os.path.join(SAMPLES_DIR, sample_name))
+    ]
+
+
+class AudioSampleLibrary:
+    """
+    The registry of audio sample collections, keyed by name. Collections are loaded on first access unless loaded upfront with `load_all`.
+    """
+
+    def __init__(self):
+        self._collections: Dict[str, AudioSampleCollection] = dict()
+        self._lock = threading.Lock()
+        self._use_bank = True
+        self._lazy = False
+        self._storage: SampleStorage = "float32"
+
+    def configure(
+        self,
+        use_bank: bool = True,
+        lazy: bool = False,
+        storage: SampleStorage = "float32",
+    ):
+        """
+        Sets how collections that are not yet loaded will be loaded. See `AudioSampleCollection`.
+        """
+        self._use_bank = use_bank
+        self._lazy = lazy
+        self._storage = storage
+
+    def __getitem__(self, name: str) -> AudioSampleCollection:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = AudioSampleCollection(
+                    load_collection_config(name),
+                    use_bank=self._use_bank,
+                    lazy=self._lazy,
+                    storage=self._storage,
+                )
+            return self._collections[name]
+
+    def is_loaded(self) -> bool:
+        # Does not take the lock so that it answers while a collection is loading.
+        return all(name in self._collections for name in list_collection_names())
+
+    def load_all(self):
+        names = list_collection_names()
+        for name in names:
+            self[name]
+        print(f"Loaded audio samples from {names}.")
+
+    def load_all_in_background(self) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.load_all,
+            name="audio-sample-library-warm-up",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+
+AUDIO_SAMPLE_LIBRARY = AudioSampleLibrary()
@@ -0,0 +1,249 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import wraps
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """
+    :param hits: The number of lookups that found a cached value.
+    :param misses: The number of lookups that had to compute the value.
+    :param evictions: The number of values dropped to stay within the bounds.
+    :param size: The number of cached values, if known.
+    :param nbytes: The number of bytes held by the cached values, if the cache is byte-bounded.
+    :param maxsize: The maximum number of cached values, if bounded.
+    :param max_bytes: The maximum number of cached bytes, if bounded.
+    """
+
+    hits: int
+    misses: int
+    evictions: int = 0
+    size: Optional[int] = None
+    nbytes: Optional[int] = None
+    maxsize: Optional[int] = None
+    max_bytes: Optional[int] = None
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+
+_CACHES: Dict[str, "LRUCache[Any, Any] | memoized_property[Any]"] = dict()
+_CACHES_LOCK = threading.Lock()
+
+
+def _register(name: str, cache: "LRUCache[Any, Any] | memoized_property[Any]"):
+    # A cache created under an existing name replaces it in the statistics.
+    with _CACHES_LOCK:
+        _CACHES[name] = cache
+
+
+def get_cache_stats() -> Dict[str, CacheStats]:
+    with _CACHES_LOCK:
+        caches = list(_CACHES.items())
+    return {name: cache.stats for name, cache in caches}
+
+
+def clear_caches():
+    with _CACHES_LOCK:
+        caches = list(_CACHES.values())
+    for cache in caches:
+        if isinstance(cache, LRUCache):
+            cache.clear()
+
+
+def get_nbytes(value: Any) -> int:
+    return int(getattr(value, "nbytes", 0))
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A named, thread-safe least-recently-used cache. Its statistics are reported by `get_cache_stats`.
+
+    :param name: The name under which the statistics are reported.
+    :param maxsize: The maximum number of entries, if bounded.
+    :param max_bytes: The maximum total size of the values in bytes, if bounded.
+    :param sizeof: Returns the size of a value in bytes. Only used if `max_bytes` is set.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[V], int] = get_nbytes,
+    ):
+        assert maxsize is None or maxsize > 0
+        assert max_bytes is None or max_bytes > 0
+        self._name = name
+        self._maxsize = maxsize
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries: OrderedDict[K, Tuple[V, int]] = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        _register(name, self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                size=len(self._entries),
+                nbytes=self._nbytes if self._max_bytes is not None else None,
+                maxsize=self._maxsize,
+                max_bytes=self._max_bytes,
+            )
+
+    def get_or_create(self, key: K, create: Callable[[], V]) -> V:
+        """
+        Returns the cached value of `key`, or caches the value returned by `create`. `create` runs without holding the lock.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self._misses += 1
+        value = create()
+        self.put(key, value)
+        return value
+
+    def put(self, key: K, value: V):
+        nbytes = self._sizeof(value) if self._max_bytes is not None else 0
+        if self._max_bytes is not None and nbytes > self._max_bytes:
+            return  # would evict everything and still not fit
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while (
+                self._maxsize is not None and len(self._entries) > self._maxsize
+            ) or (self._max_bytes is not None and self._nbytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate(self, key: K):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _remove(self, key: K):
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[1]
+
+
+def memoize(
+    name: str,
+    maxsize: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    sizeof: Callable[[Any], int] = get_nbytes,
+) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """
+    Memoizes a function with hashable arguments in an `LRUCache`. The cache is available as the `cache` attribute of the decorated function.
+
+    Methods are memoized per instance, since `self` is part of the key.
+    """
+
+    def decorator(function: Callable[..., T]) -> Callable[..., T]:
+        cache: LRUCache[Hashable, T] = LRUCache(
+            name,
+            maxsize=maxsize,
+            max_bytes=max_bytes,
+            sizeof=sizeof,
+        )
+
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            key = (args, tuple(sorted(kwargs.items())))
+            return cache.get_or_create(key, lambda: function(*args, **kwargs))
+
+        setattr(wrapper, "cache", cache)
+        return wrapper
+
+    return decorator
+
+
+class memoized_property(Generic[T]):
+    """
+    A property computed once per instance, like `functools.cached_property`, whose hits and misses are reported by `get_cache_stats`. Cached values are dropped with `memoized_property.invalidate`.
+
+    :param name: The name under which the statistics are reported.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._function: Callable[[Any], T]
+        self._attr = ""
+        self._hits = 0
+        self._misses = 0
+        _register(name, self)
+
+    def __call__(self, function: Callable[[Any], T]) -> "memoized_property[T]":
+        self._function = function
+        self.__doc__ = function.__doc__
+        return self
+
+    def __set_name__(self, owner: type, name: str):
+        self._attr = f"_memoized_{name}"
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        if instance is None:
+            return self
+        if self._attr in instance.__dict__:
+            self._hits += 1
+            return instance.__dict__[self._attr]
+        self._misses += 1
+        value = self._function(instance)
+        instance.__dict__[self._attr] = value
+        return value
+
+    def __set__(self, instance: Any, value: T):
+        raise AttributeError("Memoized properties are read-only.")
+
+    @property
+    def stats(self) -> CacheStats:
+        return CacheStats(hits=self._hits, misses=self._misses)
+
+    @staticmethod
+    def invalidate(instance: Any, name: str):
+        """
+        Drops the cached value of the property `name` of `instance`, if any.
+        """
+        instance.__dict__.pop(f"_memoized_{name}", None)
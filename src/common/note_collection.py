@@ -1,4 +1,6 @@
+import numpy as np
 from typing import List, FrozenSet, Tuple
+from numpy.typing import NDArray
 
 from common.structures.note import Note
 from common.structures.pitch import Pitch
@@ -15,6 +17,39 @@ class NoteCollection:
     def add(self, *notes: Note):
         self._notes.extend(notes)
 
+    def to_array(self) -> NDArray[np.int32]:
+        """
+        Returns the pitch, start, duration and chord degree (-1 if none) of each note.
+        """
+        array = np.array(
+            [
+                (
+                    note.pitch.value,
+                    note.start,
+                    note.duration,
+                    -1 if note.pitch.chord_degree is None else note.pitch.chord_degree,
+                )
+                for note in self._notes
+            ],
+            dtype=np.int32,
+        )
+        return array.reshape(-1, 4)
+
+    @classmethod
+    def from_array(cls, array: NDArray[np.int32]) -> "NoteCollection":
+        notes = cls()
+        notes.add(
+            *[
+                Note(
+                    Pitch(int(pitch), None if chord_degree < 0 else int(chord_degree)),
+                    int(start),
+                    int(duration),
+                )
+                for pitch, start, duration, chord_degree in array
+            ]
+        )
+        return notes
+
     def get_pitches_at_time(self, time: int) -> FrozenSet[Pitch]:
         pitches = [note.pitch for note in self._notes if note.start <= time < note.end]
         return frozenset(pitches)
@@ -0,0 +1,96 @@
+import os
+import json
+import mmap
+import struct
+import numpy as np
+from typing import Dict, Tuple, List, Any
+from numpy.typing import NDArray
+
+
+# A sample bank packs the processed audio of a sample collection into one file:
+# - 8 bytes: `_MAGIC`.
+# - 8 bytes: the length of the index as a little-endian unsigned integer.
+# - The index as UTF-8 JSON.
+# - Zero padding up to a multiple of `_ALIGNMENT` bytes.
+# - Every signal as little-endian float32, at the frame offsets listed in the index.
+SAMPLE_BANK_VERSION = 1
+SAMPLE_BANK_EXTENSION = ".bank"
+
+_MAGIC = b"PPACBANK"
+_HEADER_FORMAT = "<8sQ"
+_ALIGNMENT = 64
+
+
+SignalKey = Tuple[str, int]  # (timbre, MIDI pitch)
+
+
+class InvalidSampleBank(Exception):
+    pass
+
+
+def write_sample_bank(
+    path: str,
+    metadata: Dict[str, Any],
+    signals: Dict[SignalKey, NDArray[np.float32]],
+):
+    """
+    Writes a sample bank atomically.
+
+    :param path: The path of the bank file.
+    :param metadata: JSON-serializable data stored in the index alongside the signal table.
+    :param signals: The signals to store.
+    """
+    entries: List[Tuple[str, int, int, int]] = list()
+    offset = 0
+    for (timbre, pitch), signal in signals.items():
+        entries.append((timbre, pitch, offset, len(signal)))
+        offset += len(signal)
+    index = json.dumps(
+        {
+            "version": SAMPLE_BANK_VERSION,
+            "metadata": metadata,
+            "signals": entries,
+        }
+    ).encode()
+    header = struct.pack(_HEADER_FORMAT, _MAGIC, len(index)) + index
+    padding = -len(header) % _ALIGNMENT
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fout:
+        fout.write(header + b"\0" * padding)
+        for signal in signals.values():
+            fout.write(np.ascontiguousarray(signal, dtype="<f4").tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_sample_bank(
+    path: str,
+) -> Tuple[Dict[str, Any], Dict[SignalKey, NDArray[np.float32]]]:
+    """
+    Memory-maps a sample bank. The returned signals are read-only views into the mapping.
+
+    :param path: The path of the bank file.
+    :return: A tuple containing the metadata and the signals.
+    """
+    with open(path, "rb") as fin:
+        buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_size = struct.calcsize(_HEADER_FORMAT)
+    magic, index_size = struct.unpack_from(_HEADER_FORMAT, buffer)
+    if magic != _MAGIC:
+        raise InvalidSampleBank(f"{path} is not a sample bank.")
+    index = json.loads(buffer[header_size : header_size + index_size])
+    if index["version"] != SAMPLE_BANK_VERSION:
+        raise InvalidSampleBank(f"{path} has an unsupported version.")
+
+    data_offset = header_size + index_size
+    data_offset += -data_offset % _ALIGNMENT
+    data = np.frombuffer(buffer, dtype="<f4", offset=data_offset)
+
+    signals: Dict[SignalKey, NDArray[np.float32]] = dict()
+    for timbre, pitch, offset, length in index["signals"]:
+        if offset < 0 or length < 0 or offset + length > len(data):
+            # Such as a bank truncated by an interrupted write.
+            raise InvalidSampleBank(f"{path} is shorter than its index.")
+        signals[(timbre, pitch)] = data[offset : offset + length]
+    return index["metadata"], signals
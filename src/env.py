@@ -3,6 +3,7 @@ import typing
 import dataclasses
 from typing import Dict, Type, Literal, Tuple, Any
 from dataclasses import dataclass
+from functools import cache
 from dotenv import dotenv_values
 
 
@@ -17,18 +18,37 @@ RunMode = Literal["prod", "dev"]
 
 
 _RUN_MODE_ARGS: Tuple[RunMode, ...] = typing.get_args(RunMode)
-_RUN_MODE = os.environ.get("MODE", "dev")
-assert _RUN_MODE in _RUN_MODE_ARGS, "Invalid run mode."
 
 
 @dataclass(frozen=True)
 class Env:
+    """
+    :param WARM_UP_IN_BACKGROUND: Whether the server starts accepting requests before its workers have loaded the audio sample library.
+    :param LAZY_SAMPLE_LOADING: Whether audio sample collections decode each pitch on first use. Ignored for collections with an up-to-date sample bank.
+    :param SAMPLE_STORAGE: The type in which audio samples are kept in memory: float32, float16 or int16.
+    :param SYNTH_POOL_SIZE: The number of FluidSynth synthesizers kept loaded per soundfont. Bounds the number of concurrent MIDI renders.
+    :param MIDI_RENDERER: The renderer of MIDI parts: fluidsynth, or soundfont_player to render notes with NumPy.
+    :param WORKER_PROCESSES: The number of worker processes that run the generation pipeline. Bounds the number of concurrent generations, and each worker keeps its own audio sample library in memory.
+    :param JOB_DATABASE: The SQLite database of the job queue. Defaults to jobs.sqlite3 in OUTPUT_DIR.
+    :param RUN_JOBS: Whether the server runs queued jobs in its worker processes. Jobs can also be run by job_worker.py processes sharing the database.
+    :param ARTIFACT_DIR: The directory of the persisted outputs of the pipeline stages. Defaults to artifacts in OUTPUT_DIR.
+    """
+
     BE_AUTH_TOKEN: str
     FE_BASE_URL: str
     BE_BASE_URL: str
     INPUT_DIR: str
     OUTPUT_DIR: str
-    RUN_MODE: RunMode = _RUN_MODE
+    RUN_MODE: RunMode = "dev"
+    WARM_UP_IN_BACKGROUND: bool = True
+    LAZY_SAMPLE_LOADING: bool = False
+    SAMPLE_STORAGE: str = "float32"
+    SYNTH_POOL_SIZE: int = 1
+    MIDI_RENDERER: str = "fluidsynth"
+    WORKER_PROCESSES: int = 1
+    JOB_DATABASE: str = ""
+    RUN_JOBS: bool = True
+    ARTIFACT_DIR: str = ""
 
 
 def load_env(cls: Type[Any], path: str, default_args: Dict[str, Any] = dict()) -> Any:
@@ -45,7 +65,25 @@ def load_env(cls: Type[Any], path: str, default_args: Dict[str, Any] = dict()) -
     return cls(**{**default_args, **settings})
 
 
-ENV: Env = load_env(Env, f"../.env.{_RUN_MODE.lower()}")
+def get_run_mode() -> RunMode:
+    run_mode = os.environ.get("MODE", "dev")
+    assert run_mode in _RUN_MODE_ARGS, "Invalid run mode."
+    return run_mode
+
+
+@cache
+def get_env() -> Env:
+    """
+    Loads the environment file of the current run mode on first call.
+    """
+    run_mode = get_run_mode()
+    return load_env(
+        Env,
+        f"../.env.{run_mode.lower()}",
+        default_args={"RUN_MODE": run_mode},
+    )
+
 
-os.makedirs(ENV.INPUT_DIR, exist_ok=True)
-os.makedirs(ENV.OUTPUT_DIR, exist_ok=True)
+def create_env_dirs(env: Env):
+    os.makedirs(env.INPUT_DIR, exist_ok=True)
+    os.makedirs(env.OUTPUT_DIR, exist_ok=True)
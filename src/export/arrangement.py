@@ -1,17 +1,20 @@
 from __future__ import annotations
 
 import os
-import tempfile
-import scipy.io.wavfile as wav  # type: ignore
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Tuple, List
-from midiutil.MidiFile import MIDIFile  # type: ignore
+from typing import Dict, Iterator, Tuple, List, Literal
+from numpy.typing import NDArray
 
 from common.util import db_to_strength
-from common.audio_data import AudioData
+from common.audio_mixer import AudioSource, mix_blocks
 from common.structures.pitch import Pitch
+from export.audio_encoder import AudioEncoder, AudioEncoding
 
+import instruments.base as instrument
 import export.part as part
+import export.midi_renderer as midi_renderer
 
 
 @dataclass(frozen=True)
@@ -43,21 +46,28 @@ class ArrangementMetadata:
         return self.Duration((measure * self.beats_per_measure + beat))
 
 
+MIDIRenderer = Literal["fluidsynth", "soundfont_player"]
+
+
 @dataclass(frozen=True)
 class ArrangementExportConfig:
     """
-    TODO
+    :param midi_renderer: Renders MIDI parts with FluidSynth, or with the NumPy soundfont player.
+    :param block_size: The number of frames mixed and written at a time.
+    :param encoding: The encoding of the output file.
     """
 
     output_path: str
     sample_rate: int = 44100
     start_padding: float = 0.5  # in seconds
-    soundfont_url: str = (
-        "https://github.com/musescore/MuseScore/raw/refs/heads/master/share/sound/MS%20Basic.sf3"
+    soundfont_path: str = (
+        "../data/soundfonts/arrangement.sf2"  # built by prepare_assets.py
     )
-    soundfont_path: str = "../data/soundfonts/ms_basic.sf3"
     midi_db: float = 10.5
     sample_db: float = -1.5
+    midi_renderer: MIDIRenderer = "fluidsynth"
+    block_size: int = 2**16  # in frames
+    encoding: AudioEncoding = "wav"
 
     @property
     def start_padding_frames(self) -> int:
@@ -74,19 +84,94 @@ class Arrangement:
         self._metadata = metadata
         self._parts = parts
 
+    def to_arrays(self) -> Dict[str, NDArray[np.generic]]:
+        """
+        Returns the arrays of each part, prefixed by the index of the part, along with the type of each part. The metadata and instruments are not included.
+        """
+        arrays: Dict[str, NDArray[np.generic]] = {
+            "part_types": np.array([type(p).__name__ for p in self._parts], dtype=str)
+        }
+        for i, part_ in enumerate(self._parts):
+            arrays.update({f"{i}.{k}": v for k, v in part_.to_arrays().items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(
+        cls,
+        metadata: ArrangementMetadata,
+        instruments: List[instrument.Instrument],
+        arrays: Dict[str, NDArray[np.generic]],
+    ) -> Arrangement:
+        """
+        Rebuilds an arrangement from `to_arrays`, with the instrument of each part in order.
+        """
+        part_types = {
+            cls_.__name__: cls_
+            for cls_ in (
+                part.Part,
+                part.MIDIPart,
+                part.PercussionPart,
+                part.SampledPart,
+            )
+        }
+        parts: List[part.Part] = list()
+        for i, (part_type, instrument_) in enumerate(
+            zip(arrays["part_types"], instruments, strict=True)
+        ):
+            prefix = f"{i}."
+            part_arrays = {
+                k[len(prefix) :]: v for k, v in arrays.items() if k.startswith(prefix)
+            }
+            parts.append(
+                part_types[str(part_type)].from_arrays(
+                    metadata, instrument_, part_arrays
+                )
+            )
+        return cls(metadata, parts)
+
     def export(self, config: ArrangementExportConfig):
+        """
+        Mixes the parts block by block and writes each block as soon as it is mixed, so memory use does not grow with the length of the arrangement.
+        """
+        os.makedirs(os.path.dirname(config.output_path), exist_ok=True)
+        with AudioEncoder(
+            config.output_path, config.encoding, config.sample_rate
+        ) as output:
+            for block in self.render(config):
+                output.write(block)
 
-        midi_parts, sampled_parts = self._get_parts_by_type()
+    def render(self, config: ArrangementExportConfig) -> Iterator[NDArray[np.float32]]:
+        """
+        Yields the mix of the parts in blocks of `config.block_size` frames, as each block is mixed. `config.output_path` is not used.
+        """
 
-        output = self._midi_to_audio_data(config, midi_parts)
+        midi_parts, sampled_parts = self._get_parts_by_type()
 
-        # Add sampled instruments' WAV datas onto MIDI WAV data.
-        for part in sampled_parts:
-            array = part.get_audio_data(config).array
-            output.add_range((0, len(array)), array * db_to_strength(config.sample_db))
+        # Percussion parts tile a prerendered measure instead of going through the synthesizer.
+        percussion_parts = [p for p in midi_parts if isinstance(p, part.PercussionPart)]
+        synthesized_parts = [p for p in midi_parts if p not in percussion_parts]
+
+        sources: List[AudioSource] = [
+            midi_renderer.get_audio_source(
+                self._metadata,
+                synthesized_parts,
+                config,
+                start_frame=config.start_padding_frames,
+            )
+        ]
+        sources.extend(part_.get_audio_source(config) for part_ in percussion_parts)
+        sources.extend(
+            part_.get_audio_source(config, gain=db_to_strength(config.sample_db))
+            for part_ in sampled_parts
+        )
 
-        # Export combined WAV data and close temporary files.
-        wav.write(config.output_path, config.sample_rate, output.array)  # type: ignore
+        # Render the sources of each block concurrently. The synthesizer mostly waits on FluidSynth, and NumPy releases the GIL while mixing.
+        try:
+            with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                yield from mix_blocks(sources, config.block_size, executor)
+        finally:
+            for source in sources:
+                source.close()
 
     def _get_parts_by_type(
         self,
@@ -104,54 +189,3 @@ class Arrangement:
                 sampled_parts.append(part_)
 
         return (midi_parts, sampled_parts)
-
-    def _midi_to_audio_data(
-        self,
-        config: ArrangementExportConfig,
-        parts: List[part.MIDIPart],
-    ) -> AudioData:
-        if len(parts) == 0:
-            return AudioData()
-
-        # Download soundfont if missing.
-        if not os.path.exists(config.soundfont_path):
-            os.makedirs(os.path.dirname(config.soundfont_path), exist_ok=True)
-            os.system(f"curl -o {config.soundfont_path} -L {config.soundfont_url}")
-
-        # Create temporary files.
-        midi_file = tempfile.NamedTemporaryFile(suffix=".mid", delete=False)
-        midi_wav_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-
-        # Create MIDI data.
-        midi_data = MIDIFile(
-            numTracks=len(parts),
-            ticks_per_quarternote=self._metadata.quantization,
-        )
-        for track, part_ in enumerate(parts):
-            part_.add_notes_to_track(midi_data, track)
-
-        # Write MIDI data to MIDI file.
-        midi_data.writeFile(midi_file)  # type: ignore
-        midi_file.flush()
-
-        # Close files before FluidSynth call.
-        midi_file.close()
-        midi_wav_file.close()
-
-        # Convert MIDI file to WAV file and load WAV file.
-        os.makedirs(os.path.dirname(config.output_path), exist_ok=True)
-        os.system(
-            f"fluidsynth -ni {config.soundfont_path} {midi_file.name} -F {midi_wav_file.name} -r {config.sample_rate}"
-        )
-        output = AudioData.from_file(
-            midi_wav_file.name,
-            sample_rate=config.sample_rate,
-            db=config.midi_db,
-        )
-        output.pad_start(config.start_padding_frames)
-
-        # Delete temp files.
-        os.remove(midi_file.name)
-        os.remove(midi_wav_file.name)
-
-        return output
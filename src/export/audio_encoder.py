@@ -0,0 +1,247 @@
+import struct
+import numpy as np
+import soundfile  # type: ignore
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, Literal, Optional
+from numpy.typing import NDArray
+
+
+AudioEncoding = Literal["wav", "wav16", "flac", "ogg"]
+
+
+@dataclass(frozen=True)
+class AudioEncodingFormat:
+    """
+    :param extension: The file extension, including the dot.
+    :param media_type: The media type served for the encoding.
+    :param format: The libsndfile major format.
+    :param subtype: The libsndfile subtype.
+    """
+
+    extension: str
+    media_type: str
+    format: str
+    subtype: str
+
+    @property
+    def is_16_bit(self) -> bool:
+        return self.subtype == "PCM_16"
+
+    @property
+    def dtype(self) -> str:
+        """
+        The NumPy type of the samples written to the file.
+        """
+        return "i2" if self.is_16_bit else "f4"
+
+
+AUDIO_ENCODINGS: Dict[AudioEncoding, AudioEncodingFormat] = {
+    "wav": AudioEncodingFormat(".wav", "audio/wav", "WAV", "FLOAT"),
+    "wav16": AudioEncodingFormat(".wav", "audio/wav", "WAV", "PCM_16"),
+    "flac": AudioEncodingFormat(".flac", "audio/flac", "FLAC", "PCM_16"),
+    "ogg": AudioEncodingFormat(".ogg", "audio/ogg", "OGG", "VORBIS"),
+}
+DEFAULT_AUDIO_ENCODING: AudioEncoding = "wav"
+
+# The encoding chosen for each media type of an `Accept` header.
+_ACCEPTED_MEDIA_TYPES: Dict[str, AudioEncoding] = {
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "audio/ogg": "ogg",
+    "audio/vorbis": "ogg",
+}
+_INT16_SCALE = 2**15
+_UNKNOWN_WAV_SIZE = (
+    0xFFFFFFFF  # the chunk size of a WAV file streamed before its length is known
+)
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_IEEE_FLOAT = 3
+
+
+def negotiate_audio_encoding(accept: Optional[str]) -> AudioEncoding:
+    """
+    Returns the encoding of the supported media type with the highest quality in an `Accept` header, or the default encoding if it has none.
+    """
+    best: Optional[AudioEncoding] = None
+    best_quality = 0.0
+    for media_range in (accept or "").split(","):
+        media_type, *params = [token.strip() for token in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encoding = _ACCEPTED_MEDIA_TYPES.get(media_type.lower())
+        if encoding is not None and quality > best_quality:
+            best, best_quality = encoding, quality
+    return best or DEFAULT_AUDIO_ENCODING
+
+
+class AudioEncoder:
+    """
+    Writes mono float32 blocks to an audio file. Samples of the `wav16`, `flac` and `ogg` encodings are clipped to [-1, 1], and 16-bit encodings are quantized with triangular dither. The 32-bit float `wav` encoding writes samples unclipped.
+
+    :param file: The path or file object to write to.
+    :param encoding: The encoding of the file.
+    :param sample_rate: The sample rate of the blocks.
+    :param seed: The seed of the dither, so that equal mixes encode to equal files.
+    """
+
+    def __init__(
+        self,
+        file: str | BinaryIO,
+        encoding: AudioEncoding,
+        sample_rate: int,
+        seed: int = 0,
+    ):
+        self._format = AUDIO_ENCODINGS[encoding]
+        self._rng = np.random.default_rng(seed)
+        self._file = soundfile.SoundFile(
+            file,
+            "w",
+            samplerate=sample_rate,
+            channels=1,
+            format=self._format.format,
+            subtype=self._format.subtype,
+        )
+
+    def __enter__(self) -> "AudioEncoder":
+        return self
+
+    def __exit__(self, *args: Any):
+        self.close()
+
+    def write(self, block: NDArray[np.float32]):
+        self._file.write(_to_samples(block, self._format, self._rng))  # type: ignore
+
+    def close(self):
+        self._file.close()
+
+
+def encode_stream(
+    blocks: Iterable[NDArray[np.float32]],
+    encoding: AudioEncoding,
+    sample_rate: int,
+    seed: int = 0,
+) -> Iterator[bytes]:
+    """
+    Encodes mono float32 blocks to the bytes of an audio file, yielding bytes as each block is encoded so the file can be sent before the audio is complete. The header leaves the length of the audio unknown.
+
+    :param blocks: The blocks to encode.
+    :param encoding: The encoding of the file.
+    :param sample_rate: The sample rate of the blocks.
+    :param seed: The seed of the dither, so that equal mixes encode to equal files.
+    """
+    format = AUDIO_ENCODINGS[encoding]
+    if format.format == "WAV":
+        # libsndfile writes the length of a WAV file into its header, so write the header here instead.
+        rng = np.random.default_rng(seed)
+        yield _get_streaming_wav_header(format, sample_rate)
+        for block in blocks:
+            yield _to_samples(block, format, rng).astype(f"<{format.dtype}").tobytes()
+        return
+
+    # The header updates FLAC and Ogg write on close are dropped, which leaves the length unknown like a live stream.
+    sink = _StreamSink()
+    with AudioEncoder(sink, encoding, sample_rate, seed) as encoder:  # type: ignore
+        for block in blocks:
+            encoder.write(block)
+            if data := sink.drain():
+                yield data
+    if data := sink.drain():
+        yield data
+
+
+class _StreamSink:
+    """
+    A file that hands out bytes as they are written. Writes to bytes that were already handed out are dropped.
+    """
+
+    def __init__(self):
+        self._sent = 0
+        self._position = 0
+        self._pending = bytearray()
+
+    def write(self, data: bytes) -> int:
+        data = bytes(data)
+        start = self._position - self._sent
+        self._position += len(data)
+        if start < 0:
+            data = data[-start:]
+            start = 0
+        if start > len(self._pending):
+            self._pending.extend(bytes(start - len(self._pending)))
+        self._pending[start : start + len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._sent + len(self._pending)
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        return b""
+
+    def drain(self) -> bytes:
+        data = bytes(self._pending)
+        self._sent += len(data)
+        self._pending.clear()
+        return data
+
+
+def _to_samples(
+    block: NDArray[np.float32],
+    format: AudioEncodingFormat,
+    rng: np.random.Generator,
+) -> NDArray[Any]:
+    if format.is_16_bit:
+        return _quantize(block, rng)
+    if format.subtype == "FLOAT":
+        return block
+    return np.clip(block, -1, 1)
+
+
+def _quantize(
+    block: NDArray[np.float32], rng: np.random.Generator
+) -> NDArray[np.int16]:
+    # Triangular dither of one least significant bit decorrelates the rounding error from the signal.
+    dither = rng.random(len(block)) - rng.random(len(block))
+    scaled = block.astype(np.float64) * _INT16_SCALE + dither
+    return np.clip(np.round(scaled), -_INT16_SCALE, _INT16_SCALE - 1).astype(np.int16)
+
+
+def _get_streaming_wav_header(format: AudioEncodingFormat, sample_rate: int) -> bytes:
+    if format.is_16_bit:
+        format_tag, sample_size = _WAVE_FORMAT_PCM, 2
+    else:
+        format_tag, sample_size = _WAVE_FORMAT_IEEE_FLOAT, 4
+    fmt = struct.pack(
+        "<HHIIHHH",
+        format_tag,
+        1,  # channels
+        sample_rate,
+        sample_rate * sample_size,  # bytes per second
+        sample_size,  # bytes per frame
+        sample_size * 8,
+        0,  # no extension
+    )
+    return b"".join(
+        [
+            struct.pack("<4sI4s", b"RIFF", _UNKNOWN_WAV_SIZE, b"WAVE"),
+            struct.pack("<4sI", b"fmt ", len(fmt)),
+            fmt,
+            struct.pack("<4sI", b"data", _UNKNOWN_WAV_SIZE),
+        ]
+    )
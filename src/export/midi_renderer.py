@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import io
+import os
+import contextlib
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from typing import Iterator, List, Tuple, IO
+from numpy.typing import NDArray
+from midiutil.MidiFile import MIDIFile  # type: ignore
+
+from common.util import db_to_strength
+from common.audio_data import AudioData
+from common.audio_mixer import (
+    AudioSource,
+    OverlapAddSource,
+    StreamSource,
+    mix_blocks,
+)
+from export.synthesizer_pool import SYNTHESIZER_POOL
+from export.soundfont import get_midi_preset
+from export.soundfont_player import load_soundfont_player
+
+import export.arrangement as arrangement
+import export.part as part
+
+
+_NUM_CHANNELS = 2  # FluidSynth always renders stereo
+_READ_SIZE = 2**16
+
+
+def render_midi(
+    metadata: arrangement.ArrangementMetadata,
+    parts: List[part.MIDIPart],
+    config: arrangement.ArrangementExportConfig,
+) -> AudioData:
+    """
+    Synthesizes MIDI parts with `config.midi_renderer`. The audio is scaled by `config.midi_db` and is not padded.
+    """
+    source = get_audio_source(metadata, parts, config)
+    blocks = list(mix_blocks([source], config.block_size))
+    signal = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+    return AudioData.from_buffer(signal, config.sample_rate, shared=False)
+
+
+def get_audio_source(
+    metadata: arrangement.ArrangementMetadata,
+    parts: List[part.MIDIPart],
+    config: arrangement.ArrangementExportConfig,
+    start_frame: int = 0,
+) -> AudioSource:
+    """
+    Returns the audio of MIDI parts rendered with `config.midi_renderer` and scaled by `config.midi_db`, starting at `start_frame`. FluidSynth audio is read as it is synthesized.
+    """
+    if len(parts) == 0:
+        return StreamSource(iter(()))
+
+    if not os.path.exists(config.soundfont_path):
+        raise FileNotFoundError(
+            f"Missing soundfont {config.soundfont_path}. Run prepare_assets.py to build it."
+        )
+
+    strength = db_to_strength(config.midi_db)
+    if config.midi_renderer == "soundfont_player":
+        return _get_note_source(parts, config, start_frame, strength)
+    chunks = synthesize(to_midi_bytes(metadata, parts), config)
+    return StreamSource(_scale_chunks(chunks, strength), start_frame)
+
+
+def to_midi_bytes(
+    metadata: arrangement.ArrangementMetadata,
+    parts: List[part.MIDIPart],
+) -> bytes:
+    midi_data = MIDIFile(
+        numTracks=len(parts),
+        ticks_per_quarternote=metadata.quantization,
+    )
+    for track, part_ in enumerate(parts):
+        part_.add_notes_to_track(midi_data, track)
+    midi_file = io.BytesIO()
+    midi_data.writeFile(midi_file)  # type: ignore
+    return midi_file.getvalue()
+
+
+def synthesize(
+    midi: bytes,
+    config: arrangement.ArrangementExportConfig,
+) -> Iterator[NDArray[np.float32]]:
+    """
+    Renders a standard MIDI file with FluidSynth at `config.sample_rate`, and yields it downmixed to mono in chunks as it is synthesized.
+
+    Uses the in-process synthesizer pool if the FluidSynth library is available, so the soundfont stays loaded between renders. Otherwise, runs the FluidSynth command line.
+    """
+    if SYNTHESIZER_POOL.is_available:
+        chunks = SYNTHESIZER_POOL.stream(
+            midi, config.soundfont_path, config.sample_rate
+        )
+    else:
+        chunks = _synthesize_with_subprocess(midi, config)
+    with contextlib.closing(chunks):  # type: ignore
+        for frames in chunks:
+            yield frames.reshape(-1, _NUM_CHANNELS).mean(axis=1, dtype=np.float32)
+
+
+def _get_note_source(
+    parts: List[part.MIDIPart],
+    config: arrangement.ArrangementExportConfig,
+    start_frame: int,
+    gain: float,
+) -> OverlapAddSource:
+    """
+    Renders the notes of MIDI parts with the soundfont player, mixed like the notes of sampled parts.
+    """
+    player = load_soundfont_player(config.soundfont_path)
+    notes: List[Tuple[int, int, int, int, int]] = list()
+    start_frames: List[int] = list()
+    lengths: List[int] = list()
+    for part_ in parts:
+        export_config = part_.instrument.export_config
+        bank, program = get_midi_preset(
+            export_config.instrument_id, export_config.channel
+        )
+        for note_start, num_frames, key in part_.get_note_frames(config):
+            note = (bank, program, key, export_config.volume, num_frames)
+            notes.append(note)
+            start_frames.append(start_frame + note_start)
+            lengths.append(player.get_note_length(*note, config.sample_rate))
+
+    def get_waveform(i: int) -> NDArray[np.float32]:
+        return player.get_note_waveform(*notes[i], config.sample_rate)
+
+    return OverlapAddSource(
+        np.array(start_frames, dtype=np.int64),
+        np.array(lengths, dtype=np.int64),
+        get_waveform,
+        gain,
+    )
+
+
+def _scale_chunks(
+    chunks: Iterator[NDArray[np.float32]],
+    strength: float,
+) -> Iterator[NDArray[np.float32]]:
+    with contextlib.closing(chunks):  # type: ignore
+        for chunk in chunks:
+            yield chunk * strength
+
+
+def _synthesize_with_subprocess(
+    midi: bytes,
+    config: arrangement.ArrangementExportConfig,
+) -> Iterator[NDArray[np.float32]]:
+    """
+    Runs the FluidSynth command line and yields its interleaved stereo frames as they are read.
+
+    The MIDI file is passed through an in-memory file and the audio is read back as raw float32 PCM from a pipe, so nothing is written to disk or decoded.
+    """
+    midi_fd = _open_midi_fd(midi)
+    pcm_read_fd, pcm_write_fd = os.pipe()
+    try:
+        process = subprocess.Popen(
+            [
+                "fluidsynth",
+                "-ni",
+                "-T",
+                "raw",
+                "-O",
+                "float",
+                "-E",
+                "little",
+                "-r",
+                str(config.sample_rate),
+                "-F",
+                f"/dev/fd/{pcm_write_fd}",
+                config.soundfont_path,
+                f"/dev/fd/{midi_fd}",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=(midi_fd, pcm_write_fd),
+        )
+    finally:
+        os.close(midi_fd)
+        os.close(pcm_write_fd)
+
+    assert process.stderr is not None
+    stderr = bytearray()
+    stderr_reader = threading.Thread(target=_read_all, args=(process.stderr, stderr))
+    stderr_reader.start()
+    frame_size = 4 * _NUM_CHANNELS
+    try:
+        with os.fdopen(pcm_read_fd, "rb") as pcm_pipe:
+            pending = b""
+            while chunk := pcm_pipe.read(_READ_SIZE):
+                pcm = pending + chunk
+                size = len(pcm) // frame_size * frame_size
+                pending = pcm[size:]
+                yield np.frombuffer(pcm, dtype="<f4", count=size // 4)
+        process.wait()
+    finally:
+        if process.poll() is None:  # closed before FluidSynth finished
+            process.kill()
+            process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"FluidSynth failed: {stderr.decode(errors='replace')}")
+
+
+def _open_midi_fd(midi: bytes) -> int:
+    """
+    Returns a seekable file descriptor holding `midi`. FluidSynth seeks in MIDI files, so a pipe does not work.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("arrangement.mid")
+    else:
+        fd = os.dup(tempfile.TemporaryFile().fileno())
+    view = memoryview(midi)
+    while len(view) > 0:
+        view = view[os.write(fd, view) :]
+    os.lseek(fd, 0, os.SEEK_SET)
+    return fd
+
+
+def _read_all(source: IO[bytes], destination: bytearray):
+    while chunk := source.read(_READ_SIZE):
+        destination.extend(chunk)
@@ -1,11 +1,19 @@
 from __future__ import annotations
 
 import math
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Tuple
+from numpy.typing import NDArray
 from midiutil.MidiFile import MIDIFile  # type: ignore
 
 from common.util import db_to_strength
+from common.cache import LRUCache
 from common.note_collection import NoteCollection
 from common.audio_data import AudioData
+from common.audio_mixer import OverlapAddSource
+from common.structures.note import Note
+from common.structures.pitch import Pitch
 from common.audio_sample import (
     AudioSample,
     AUDIO_SAMPLE_LIBRARY,
@@ -14,6 +22,7 @@ from common.audio_sample import (
 import instruments.base as instruments
 
 import export.arrangement as arrangement
+import export.midi_renderer as midi_renderer
 
 
 class Part:
@@ -32,6 +41,35 @@ class Part:
     def notes(self):
         return self._notes
 
+    def to_arrays(self) -> Dict[str, NDArray[np.generic]]:
+        """
+        Returns the arrays `from_arrays` rebuilds the part from.
+        """
+        return {"notes": self._notes.to_array()}
+
+    @classmethod
+    def from_arrays(
+        cls,
+        arrangement_metadata: arrangement.ArrangementMetadata,
+        instrument: instruments.Instrument,
+        arrays: Dict[str, NDArray[np.generic]],
+    ) -> "Part":
+        return cls(
+            arrangement_metadata,
+            instrument,  # type: ignore
+            NoteCollection.from_array(arrays["notes"]),  # type: ignore
+        )
+
+    def _to_frame(
+        self, config: arrangement.ArrangementExportConfig, time: float
+    ) -> int:
+        m = config.sample_rate * 60 / self._arrangement_metadata.beats_per_minute
+        m *= (
+            self._arrangement_metadata.beat_duration
+            / self._arrangement_metadata.quantization
+        )
+        return int(m * time)
+
 
 class MIDIPart(Part):
 
@@ -40,8 +78,34 @@ class MIDIPart(Part):
         arrangement_metadata: arrangement.ArrangementMetadata,
         instrument: instruments.MIDIInstrument,
         notes: NoteCollection,
+        end: Optional[int] = None,
     ):
+        """
+        :param end: The time at which the track ends. Synthesizers stop rendering at the end of the track, so the notes released before it decay in full. Defaults to the end of the last note.
+        """
         super().__init__(arrangement_metadata, instrument, notes)
+        self._end = end
+
+    @property
+    def instrument(self) -> instruments.MIDIInstrument:
+        assert isinstance(self._instrument, instruments.MIDIInstrument)
+        return self._instrument
+
+    def get_note_frames(
+        self,
+        config: arrangement.ArrangementExportConfig,
+    ) -> List[Tuple[int, int, int]]:
+        """
+        Returns the start frame, the number of held frames and the MIDI key of each note, in note order.
+        """
+        return [
+            (
+                self._to_frame(config, note.start),
+                self._to_frame(config, note.duration),
+                note.pitch.value,
+            )
+            for note in self.notes.list()
+        ]
 
     def add_notes_to_track(self, midi: MIDIFile, track: int):
         assert isinstance(self._instrument, instruments.MIDIInstrument)
@@ -81,6 +145,153 @@ class MIDIPart(Part):
                 note.duration * time_scale,
                 volume,
             )
+        if self._end is not None:
+            midi.addText(track, self._end * time_scale, "end")  # type: ignore
+
+
+_PERCUSSION_MEASURE_CACHE: LRUCache[Hashable, NDArray[np.float32]] = LRUCache(
+    "part.percussion_measures",
+    max_bytes=64 * 2**20,
+)
+# The number of measures rendered after a percussion measure, so the decay of its last hits is not cut off.
+_PERCUSSION_TAIL_MEASURES = 1
+
+
+class PercussionPart(MIDIPart):
+    """
+    A MIDI part that repeats a one-measure pattern. Its audio tiles a single rendered measure, which is cached per pattern, instrument, arrangement metadata and export config.
+
+    :param pattern: The notes of one measure, timed from the start of the measure.
+    :param num_measures: The number of times the pattern is repeated.
+    """
+
+    def __init__(
+        self,
+        arrangement_metadata: arrangement.ArrangementMetadata,
+        instrument: instruments.MIDIInstrument,
+        pattern: NoteCollection,
+        num_measures: int,
+    ):
+        notes = NoteCollection()
+        for measure in range(num_measures):
+            offset = arrangement_metadata.Time(measure, 0)
+            notes.add(
+                *[
+                    Note(note.pitch, note.start + offset, note.duration)
+                    for note in pattern.list()
+                ]
+            )
+        super().__init__(arrangement_metadata, instrument, notes)
+        self._pattern = pattern
+        self._num_measures = num_measures
+
+    def to_arrays(self) -> Dict[str, NDArray[np.generic]]:
+        return {
+            "pattern": self._pattern.to_array(),
+            "num_measures": np.array(self._num_measures),
+        }
+
+    @classmethod
+    def from_arrays(
+        cls,
+        arrangement_metadata: arrangement.ArrangementMetadata,
+        instrument: instruments.Instrument,
+        arrays: Dict[str, NDArray[np.generic]],
+    ) -> "PercussionPart":
+        assert isinstance(instrument, instruments.MIDIInstrument)
+        return cls(
+            arrangement_metadata,
+            instrument,
+            NoteCollection.from_array(arrays["pattern"]),  # type: ignore
+            int(arrays["num_measures"]),
+        )
+
+    def get_audio_source(
+        self,
+        config: arrangement.ArrangementExportConfig,
+    ) -> OverlapAddSource:
+        """
+        Returns the audio of the part, scaled by `config.midi_db` and padded by `config.start_padding`.
+        """
+        measure = self._get_measure_audio(config)
+        start_frames = np.array(
+            [
+                config.start_padding_frames
+                + self._to_frame(config, self._arrangement_metadata.Time(i, 0))
+                for i in range(self._num_measures)
+            ],
+            dtype=np.int64,
+        )
+        return OverlapAddSource(
+            start_frames,
+            np.full_like(start_frames, len(measure)),
+            lambda i: measure,
+        )
+
+    def _get_measure_audio(
+        self,
+        config: arrangement.ArrangementExportConfig,
+    ) -> NDArray[np.float32]:
+        assert isinstance(self._instrument, instruments.MIDIInstrument)
+        key = (
+            tuple(
+                (note.pitch.value, note.start, note.duration)
+                for note in self._pattern.list()
+            ),
+            self._instrument.export_config,
+            self._arrangement_metadata,
+            config.sample_rate,
+            config.soundfont_path,
+            config.midi_db,
+            config.midi_renderer,
+        )
+
+        def render() -> NDArray[np.float32]:
+            measure = MIDIPart(
+                self._arrangement_metadata,
+                self._instrument,
+                self._pattern,
+                end=self._arrangement_metadata.Time(1 + _PERCUSSION_TAIL_MEASURES, 0),
+            )
+            rendered = midi_renderer.render_midi(
+                self._arrangement_metadata,
+                [measure],
+                config,
+            ).array
+            # Keep at least the whole measure, and drop the silence left after the hits decay.
+            audible = np.flatnonzero(rendered)
+            num_frames = max(
+                self._to_frame(config, self._arrangement_metadata.Time(1, 0)),
+                audible[-1] + 1 if len(audible) > 0 else 0,
+            )
+            array = np.zeros(num_frames, dtype=np.float32)
+            array[: min(num_frames, len(rendered))] = rendered[:num_frames]
+            array.setflags(write=False)
+            return array
+
+        return _PERCUSSION_MEASURE_CACHE.get_or_create(key, render)
+
+
+@dataclass(frozen=True)
+class NoteRenderTable:
+    """
+    The frame offsets of every renderable note in a sampled part, in note order.
+
+    :param start_frames: The output frame at which each note starts.
+    :param lengths: The number of frames rendered for each note.
+    :param timbres: The timbre of each note.
+    :param pitches: The pitch of each note.
+    :param samples: The audio sample of each note.
+    """
+
+    start_frames: NDArray[np.int64]
+    lengths: NDArray[np.int64]
+    timbres: List[str]
+    pitches: List[Pitch]
+    samples: List[AudioSample]
+
+    def __len__(self) -> int:
+        return len(self.samples)
 
 
 class SampledPart(Part):
@@ -90,41 +301,107 @@ class SampledPart(Part):
         arrangement_metadata: arrangement.ArrangementMetadata,
         instrument: instruments.SampledInstrument,
         notes: NoteCollection,
+        seed: int = 0,
     ):
+        """
+        :param seed: The seed of the timbre assignment. Parts with the same seed assign the same timbre to the note at the same index.
+        """
         super().__init__(arrangement_metadata, instrument, notes)
+        self._seed = seed
 
-    def get_audio_data(self, config: arrangement.ArrangementExportConfig) -> AudioData:
-        assert isinstance(self._instrument, instruments.SampledInstrument)
+    def to_arrays(self) -> Dict[str, NDArray[np.generic]]:
+        return {**super().to_arrays(), "seed": np.array(self._seed)}
 
-        def to_frame(time: float) -> int:
-            m = config.sample_rate * 60 / self._arrangement_metadata.beats_per_minute
-            m *= (
-                self._arrangement_metadata.beat_duration
-                / self._arrangement_metadata.quantization
-            )
-            return int(m * time)
+    @classmethod
+    def from_arrays(
+        cls,
+        arrangement_metadata: arrangement.ArrangementMetadata,
+        instrument: instruments.Instrument,
+        arrays: Dict[str, NDArray[np.generic]],
+    ) -> "SampledPart":
+        assert isinstance(instrument, instruments.SampledInstrument)
+        return cls(
+            arrangement_metadata,
+            instrument,
+            NoteCollection.from_array(arrays["notes"]),  # type: ignore
+            int(arrays["seed"]),
+        )
+
+    def get_note_render_table(
+        self,
+        config: arrangement.ArrangementExportConfig,
+    ) -> NoteRenderTable:
+        assert isinstance(self._instrument, instruments.SampledInstrument)
 
         def get_shift_size(sample: AudioSample) -> int:
             return config.start_padding_frames + sample.timbre_properties.frame_shift
 
         sample_manager = AUDIO_SAMPLE_LIBRARY[self._instrument.export_config.name]
 
-        audio_data = AudioData()
-        for i, note in enumerate(self.notes.list()):
-            timbre = sample_manager.get_random_timbre(i)
+        start_frames: List[int] = list()
+        lengths: List[int] = list()
+        timbres: List[str] = list()
+        pitches: List[Pitch] = list()
+        samples: List[AudioSample] = list()
+        notes = self.notes.list()
+        note_timbres = sample_manager.get_random_timbres(
+            len(notes),
+            np.random.default_rng(self._seed),
+        )
+        for note, timbre in zip(notes, note_timbres):
             sample = sample_manager.get_sample(timbre, note.pitch)
             if not sample:  # ignore out-of-range samples
                 # TODO: handle this properly
                 continue
-            note_len = min(len(sample.audio.array), to_frame(note.duration))
-            start_frame = to_frame(note.start) + get_shift_size(sample)
-            note_range = (start_frame, start_frame + note_len)
-
-            audio_data.add_range(
-                note_range,
-                sample.audio.slice(0, note_len).array
-                * db_to_strength(self._instrument.export_config.db)
-                * sample.timbre_properties.get_envelope(note_len),
+            start_frames.append(
+                self._to_frame(config, note.start) + get_shift_size(sample)
+            )
+            lengths.append(min(len(sample), self._to_frame(config, note.duration)))
+            timbres.append(timbre)
+            pitches.append(note.pitch)
+            samples.append(sample)
+
+        return NoteRenderTable(
+            start_frames=np.array(start_frames, dtype=np.int64),
+            lengths=np.array(lengths, dtype=np.int64),
+            timbres=timbres,
+            pitches=pitches,
+            samples=samples,
+        )
+
+    def get_audio_source(
+        self,
+        config: arrangement.ArrangementExportConfig,
+        gain: float = 1,
+    ) -> OverlapAddSource:
+        """
+        Returns the audio of the part, padded by `config.start_padding`. Note waveforms are fetched as the blocks that overlap them are rendered.
+
+        :param gain: The gain applied to the mixed notes.
+        """
+        assert isinstance(self._instrument, instruments.SampledInstrument)
+
+        table = self.get_note_render_table(config)
+        sample_manager = AUDIO_SAMPLE_LIBRARY[self._instrument.export_config.name]
+        strength = db_to_strength(self._instrument.export_config.db)
+        lengths = table.lengths.tolist()
+
+        def get_waveform(i: int) -> NDArray[np.float32]:
+            waveform = sample_manager.get_note_waveform(
+                table.timbres[i],
+                table.pitches[i],
+                lengths[i],
+                strength,
             )
+            assert waveform is not None  # the table only holds notes with a sample
+            return waveform
+
+        return OverlapAddSource(table.start_frames, table.lengths, get_waveform, gain)
 
-        return audio_data
+    def get_audio_data(self, config: arrangement.ArrangementExportConfig) -> AudioData:
+        source = self.get_audio_source(config)
+        return AudioData.from_buffer(
+            source.render(0, source.num_frames),
+            config.sample_rate,
+            shared=False,
+        )
@@ -0,0 +1,328 @@
+import io
+import os
+import struct
+import numpy as np
+import soundfile  # type: ignore
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Set, Tuple
+from numpy.typing import NDArray
+
+
+PERCUSSION_CHANNEL = 9
+PERCUSSION_BANK = 128
+
+_PHDR = np.dtype(
+    [
+        ("name", "S20"),
+        ("preset", "<u2"),
+        ("bank", "<u2"),
+        ("bag", "<u2"),
+        ("library", "<u4"),
+        ("genre", "<u4"),
+        ("morphology", "<u4"),
+    ]
+)
+_INST = np.dtype([("name", "S20"), ("bag", "<u2")])
+_BAG = np.dtype([("gen", "<u2"), ("mod", "<u2")])
+_MOD = np.dtype(
+    [
+        ("src", "<u2"),
+        ("dest", "<u2"),
+        ("amount", "<i2"),
+        ("amount_src", "<u2"),
+        ("transform", "<u2"),
+    ]
+)
+_GEN = np.dtype([("oper", "<u2"), ("amount", "<u2")])
+_SHDR = np.dtype(
+    [
+        ("name", "S20"),
+        ("start", "<u4"),
+        ("end", "<u4"),
+        ("loop_start", "<u4"),
+        ("loop_end", "<u4"),
+        ("sample_rate", "<u4"),
+        ("pitch", "u1"),
+        ("pitch_correction", "i1"),
+        ("link", "<u2"),
+        ("type", "<u2"),
+    ]
+)
+_PDTA_CHUNKS: Dict[bytes, np.dtype] = {
+    b"phdr": _PHDR,
+    b"pbag": _BAG,
+    b"pmod": _MOD,
+    b"pgen": _GEN,
+    b"inst": _INST,
+    b"ibag": _BAG,
+    b"imod": _MOD,
+    b"igen": _GEN,
+    b"shdr": _SHDR,
+}
+
+_GEN_INSTRUMENT = 41
+_GEN_SAMPLE_ID = 53
+_SAMPLE_TYPE_MONO = 1
+_SAMPLE_TYPE_VORBIS = 0x10
+_SAMPLE_TYPE_ROM = 0x8000
+_SAMPLE_PADDING = 46  # zero frames required after each sample
+
+
+class InvalidSoundFont(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class SoundFont:
+    """
+    The chunks of an SF2 or SF3 file.
+
+    :param info: The INFO subchunks, in file order.
+    :param sample_data: The contents of the smpl chunk. 16-bit PCM for SF2, Ogg Vorbis streams for compressed SF3 samples.
+    :param pdta: The records of each pdta subchunk, including the terminal records.
+    """
+
+    info: List[Tuple[bytes, bytes]]
+    sample_data: bytes
+    pdta: Dict[bytes, NDArray[np.void]]
+
+    @property
+    def presets(self) -> Set[Tuple[int, int]]:
+        """
+        The bank and program of every preset.
+        """
+        return {(int(h["bank"]), int(h["preset"])) for h in self.pdta[b"phdr"][:-1]}
+
+
+def get_midi_preset(program: int, channel: int) -> Tuple[int, int]:
+    """
+    Returns the bank and program that a General MIDI synthesizer plays for a program on a channel.
+    """
+    return (PERCUSSION_BANK if channel == PERCUSSION_CHANNEL else 0, program)
+
+
+def read_soundfont(path: str) -> SoundFont:
+    with open(path, "rb") as file:
+        riff_id, _, form = struct.unpack("<4sI4s", file.read(12))
+        if riff_id != b"RIFF" or form != b"sfbk":
+            raise InvalidSoundFont(f"{path} is not a soundfont.")
+        lists = {list_type: data for list_type, data in _read_lists(file)}
+
+    if not all(chunk in lists for chunk in (b"INFO", b"sdta", b"pdta")):
+        raise InvalidSoundFont(f"{path} is missing chunks.")
+    sdta = dict(_read_chunks(lists[b"sdta"]))
+    pdta = dict(_read_chunks(lists[b"pdta"]))
+    return SoundFont(
+        info=_read_chunks(lists[b"INFO"]),
+        sample_data=sdta.get(b"smpl", b""),
+        pdta={
+            chunk: np.frombuffer(pdta[chunk], dtype=dtype).copy()
+            for chunk, dtype in _PDTA_CHUNKS.items()
+        },
+    )
+
+
+def subset_soundfont(soundfont: SoundFont, presets: Set[Tuple[int, int]]) -> SoundFont:
+    """
+    Keeps only the given presets, and the instruments and samples they reference. Compressed samples are decoded, so the subset is a plain SF2.
+
+    :param soundfont: The soundfont to subset.
+    :param presets: The bank and program of each preset to keep.
+    """
+    missing = presets - soundfont.presets
+    if len(missing) > 0:
+        raise InvalidSoundFont(f"Missing presets (bank, program): {sorted(missing)}.")
+
+    pdta = soundfont.pdta
+    phdr = pdta[b"phdr"]
+    kept_presets = [
+        i
+        for i in range(len(phdr) - 1)
+        if (int(phdr[i]["bank"]), int(phdr[i]["preset"])) in presets
+    ]
+    new_phdr, pbag, pmod, pgen, kept_instruments = _subset_zones(
+        phdr, pdta[b"pbag"], pdta[b"pmod"], pdta[b"pgen"], kept_presets, _GEN_INSTRUMENT
+    )
+    new_inst, ibag, imod, igen, kept_samples = _subset_zones(
+        pdta[b"inst"],
+        pdta[b"ibag"],
+        pdta[b"imod"],
+        pdta[b"igen"],
+        kept_instruments,
+        _GEN_SAMPLE_ID,
+    )
+    shdr, sample_data = _subset_samples(soundfont, kept_samples)
+
+    info = [(chunk, data) for chunk, data in soundfont.info if chunk != b"ifil"]
+    info.insert(0, (b"ifil", struct.pack("<HH", 2, 4)))
+    return SoundFont(
+        info=info,
+        sample_data=sample_data,
+        pdta={
+            b"phdr": new_phdr,
+            b"pbag": pbag,
+            b"pmod": pmod,
+            b"pgen": pgen,
+            b"inst": new_inst,
+            b"ibag": ibag,
+            b"imod": imod,
+            b"igen": igen,
+            b"shdr": shdr,
+        },
+    )
+
+
+def write_soundfont(path: str, soundfont: SoundFont):
+    """
+    Writes an SF2 file. The file is written to a temporary path first, so readers never see a partial soundfont.
+    """
+    info = b"".join(_chunk(chunk, data) for chunk, data in soundfont.info)
+    sdta = _chunk(b"smpl", soundfont.sample_data)
+    pdta = b"".join(
+        _chunk(chunk, soundfont.pdta[chunk].tobytes()) for chunk in _PDTA_CHUNKS
+    )
+    body = b"sfbk" + b"".join(
+        _chunk(b"LIST", list_type + data)
+        for list_type, data in ((b"INFO", info), (b"sdta", sdta), (b"pdta", pdta))
+    )
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(_chunk(b"RIFF", body))
+    os.replace(temp_path, path)
+
+
+def _read_lists(file: BinaryIO) -> List[Tuple[bytes, bytes]]:
+    lists: List[Tuple[bytes, bytes]] = list()
+    for chunk, data in _read_chunks(file.read()):
+        if chunk == b"LIST":
+            lists.append((data[:4], data[4:]))
+    return lists
+
+
+def _read_chunks(data: bytes) -> List[Tuple[bytes, bytes]]:
+    chunks: List[Tuple[bytes, bytes]] = list()
+    position = 0
+    while position + 8 <= len(data):
+        chunk, size = struct.unpack_from("<4sI", data, position)
+        chunks.append((chunk, data[position + 8 : position + 8 + size]))
+        position += 8 + size + size % 2
+    return chunks
+
+
+def _chunk(chunk: bytes, data: bytes) -> bytes:
+    return struct.pack("<4sI", chunk, len(data)) + data + b"\0" * (len(data) % 2)
+
+
+def _subset_zones(
+    headers: NDArray[np.void],
+    bags: NDArray[np.void],
+    mods: NDArray[np.void],
+    gens: NDArray[np.void],
+    kept: List[int],
+    reference_oper: int,
+) -> Tuple[
+    NDArray[np.void], NDArray[np.void], NDArray[np.void], NDArray[np.void], List[int]
+]:
+    """
+    Copies the zones of the kept presets or instruments, and renumbers the instruments or samples they reference.
+
+    :return: The new headers, bags, modulators and generators, each ending with a terminal record, and the original indices of the referenced instruments or samples in their new order.
+    """
+    new_bags: List[NDArray[np.void]] = list()
+    new_mods: List[NDArray[np.void]] = list()
+    new_gens: List[NDArray[np.void]] = list()
+    references: Dict[int, int] = dict()
+    num_bags = num_mods = num_gens = 0
+
+    new_headers = np.zeros(len(kept) + 1, dtype=headers.dtype)
+    for i, header in enumerate(kept):
+        new_headers[i] = headers[header]
+        new_headers["bag"][i] = num_bags
+        for bag in range(int(headers[header]["bag"]), int(headers[header + 1]["bag"])):
+            zone_mods = mods[int(bags[bag]["mod"]) : int(bags[bag + 1]["mod"])]
+            zone_gens = gens[int(bags[bag]["gen"]) : int(bags[bag + 1]["gen"])].copy()
+            for j in np.flatnonzero(zone_gens["oper"] == reference_oper):
+                reference = int(zone_gens["amount"][j])
+                zone_gens["amount"][j] = references.setdefault(
+                    reference, len(references)
+                )
+            new_bags.append(np.array([(num_gens, num_mods)], dtype=bags.dtype))
+            new_mods.append(zone_mods)
+            new_gens.append(zone_gens)
+            num_bags += 1
+            num_mods += len(zone_mods)
+            num_gens += len(zone_gens)
+
+    new_headers["name"][-1] = headers["name"][-1]
+    new_headers["bag"][-1] = num_bags
+    new_bags.append(np.array([(num_gens, num_mods)], dtype=bags.dtype))
+    new_mods.append(np.zeros(1, dtype=mods.dtype))
+    new_gens.append(np.zeros(1, dtype=gens.dtype))
+    return (
+        new_headers,
+        np.concatenate(new_bags),
+        np.concatenate(new_mods),
+        np.concatenate(new_gens),
+        list(references),
+    )
+
+
+def _subset_samples(
+    soundfont: SoundFont,
+    kept: List[int],
+) -> Tuple[NDArray[np.void], bytes]:
+    """
+    Copies the kept samples, and the stereo samples linked to them, into new 16-bit PCM sample data. The kept samples keep their order, so the renumbered sample references stay valid.
+    """
+    shdr = soundfont.pdta[b"shdr"]
+    samples = list(kept)
+    for sample in samples:
+        link = int(shdr["link"][sample])
+        sample_type = int(shdr["type"][sample]) & ~_SAMPLE_TYPE_VORBIS
+        if sample_type != _SAMPLE_TYPE_MONO and link not in samples:
+            samples.append(link)
+    indices = {sample: i for i, sample in enumerate(samples)}
+
+    new_shdr = np.zeros(len(samples) + 1, dtype=shdr.dtype)
+    sample_data = io.BytesIO()
+    position = 0
+    for i, sample in enumerate(samples):
+        header = shdr[sample]
+        sample_type = int(header["type"])
+        if sample_type & _SAMPLE_TYPE_ROM:
+            raise InvalidSoundFont(f"ROM sample {header['name']!r} is not supported.")
+        frames, loop_start, loop_end = _decode_sample(soundfont.sample_data, header)
+        sample_data.write(frames.astype("<i2").tobytes())
+        sample_data.write(bytes(2 * _SAMPLE_PADDING))
+
+        new_shdr[i] = header
+        new_shdr["start"][i] = position
+        new_shdr["end"][i] = position + len(frames)
+        new_shdr["loop_start"][i] = position + loop_start
+        new_shdr["loop_end"][i] = position + loop_end
+        new_shdr["type"][i] = sample_type & ~_SAMPLE_TYPE_VORBIS
+        new_shdr["link"][i] = indices.get(int(header["link"]), 0)
+        position += len(frames) + _SAMPLE_PADDING
+
+    new_shdr["name"][-1] = shdr["name"][-1]
+    return new_shdr, sample_data.getvalue()
+
+
+def _decode_sample(
+    sample_data: bytes,
+    header: np.void,
+) -> Tuple[NDArray[np.int16], int, int]:
+    """
+    Returns the 16-bit frames of a sample and its loop points relative to its start.
+    """
+    start, end = int(header["start"]), int(header["end"])
+    if header["type"] & _SAMPLE_TYPE_VORBIS:
+        # SF3 stores byte offsets of an Ogg Vorbis stream, and loop points relative to the decoded sample.
+        frames, _ = soundfile.read(io.BytesIO(sample_data[start:end]), dtype="int16")  # type: ignore
+        return frames, int(header["loop_start"]), int(header["loop_end"])
+    frames = np.frombuffer(
+        sample_data, dtype="<i2", count=end - start, offset=2 * start
+    )
+    return frames, int(header["loop_start"]) - start, int(header["loop_end"]) - start
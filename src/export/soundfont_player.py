@@ -0,0 +1,431 @@
+import math
+import itertools
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Tuple
+from numpy.typing import NDArray
+
+from common.cache import LRUCache, memoize
+from export.soundfont import SoundFont, read_soundfont
+
+
+# The generators the player understands. See section 8.1.2 of the SoundFont 2.04 specification.
+_GEN_START_OFFSET = 0
+_GEN_END_OFFSET = 1
+_GEN_LOOP_START_OFFSET = 2
+_GEN_LOOP_END_OFFSET = 3
+_GEN_START_COARSE_OFFSET = 4
+_GEN_END_COARSE_OFFSET = 12
+_GEN_PAN = 17
+_GEN_DELAY = 33
+_GEN_ATTACK = 34
+_GEN_HOLD = 35
+_GEN_DECAY = 36
+_GEN_SUSTAIN = 37
+_GEN_RELEASE = 38
+_GEN_INSTRUMENT = 41
+_GEN_KEY_RANGE = 43
+_GEN_VELOCITY_RANGE = 44
+_GEN_LOOP_START_COARSE_OFFSET = 45
+_GEN_LOOP_END_COARSE_OFFSET = 50
+_GEN_ATTENUATION = 48
+_GEN_COARSE_TUNE = 51
+_GEN_FINE_TUNE = 52
+_GEN_SAMPLE_ID = 53
+_GEN_SAMPLE_MODES = 54
+_GEN_SCALE_TUNING = 56
+_GEN_ROOT_KEY = 58
+
+_GEN_DEFAULTS: Dict[int, int] = {
+    _GEN_DELAY: -12000,
+    _GEN_ATTACK: -12000,
+    _GEN_HOLD: -12000,
+    _GEN_DECAY: -12000,
+    _GEN_RELEASE: -12000,
+    _GEN_KEY_RANGE: 127 << 8,
+    _GEN_VELOCITY_RANGE: 127 << 8,
+    _GEN_SCALE_TUNING: 100,
+    _GEN_ROOT_KEY: -1,
+}
+# Generators that a preset zone cannot add to an instrument zone.
+_GEN_NOT_ADDITIVE = {
+    _GEN_START_OFFSET,
+    _GEN_END_OFFSET,
+    _GEN_LOOP_START_OFFSET,
+    _GEN_LOOP_END_OFFSET,
+    _GEN_START_COARSE_OFFSET,
+    _GEN_END_COARSE_OFFSET,
+    _GEN_INSTRUMENT,
+    _GEN_KEY_RANGE,
+    _GEN_VELOCITY_RANGE,
+    _GEN_LOOP_START_COARSE_OFFSET,
+    _GEN_LOOP_END_COARSE_OFFSET,
+    _GEN_SAMPLE_ID,
+    _GEN_SAMPLE_MODES,
+    _GEN_ROOT_KEY,
+}
+
+_GAIN = 0.2  # the default gain of FluidSynth, so `midi_db` means the same for both renderers
+_SILENCE_CB = 960  # attenuation in centibels at which a released voice stops
+
+
+@dataclass(frozen=True)
+class SoundFontZone:
+    """
+    A sample with the generators of its preset and instrument zones combined.
+
+    :param key_range: The lowest and highest key the zone plays.
+    :param velocity_range: The lowest and highest velocity the zone plays.
+    :param sample_index: The index of the sample header.
+    :param start: The first frame of the sample in the sample data.
+    :param end: The frame after the last frame of the sample in the sample data.
+    :param loop_start: The first frame of the loop in the sample data.
+    :param loop_end: The frame after the last frame of the loop in the sample data.
+    :param loops: Whether the sample loops while the note sounds.
+    :param sample_rate: The sample rate of the sample.
+    :param root_key: The key at which the sample plays at its recorded pitch.
+    :param tuning: The tuning of the zone in cents, including the sample's pitch correction.
+    :param scale_tuning: The pitch change in cents per key.
+    :param attenuation: The attenuation of the zone in centibels.
+    :param pan: The pan of the zone, from -500 (left) to 500 (right).
+    :param envelope: The delay, attack, hold, decay and release of the volume envelope in seconds, and its sustain attenuation in centibels.
+    """
+
+    key_range: Tuple[int, int]
+    velocity_range: Tuple[int, int]
+    sample_index: int
+    start: int
+    end: int
+    loop_start: int
+    loop_end: int
+    loops: bool
+    sample_rate: int
+    root_key: int
+    tuning: int
+    scale_tuning: int
+    attenuation: int
+    pan: int
+    envelope: Tuple[float, float, float, float, float, float]
+
+    def plays(self, key: int, velocity: int) -> bool:
+        return (
+            self.key_range[0] <= key <= self.key_range[1]
+            and self.velocity_range[0] <= velocity <= self.velocity_range[1]
+        )
+
+
+_PLAYER_IDS = itertools.count()
+_NOTE_WAVEFORM_CACHE: LRUCache[Hashable, NDArray[np.float32]] = LRUCache(
+    "soundfont_player.note_waveforms",
+    max_bytes=64 * 2**20,
+)
+
+
+class SoundFontPlayer:
+    """
+    Renders MIDI notes from the sample zones of an SF2 file with NumPy, as an alternative to FluidSynth.
+
+    Covers the volume envelope, tuning, attenuation, pan, sample offsets and looping. Modulators, filters and LFOs are ignored, and velocity scales the amplitude by `(velocity / 127) ** 2`.
+
+    :param soundfont: The soundfont to play. Compressed SF3 samples are not supported.
+    """
+
+    def __init__(self, soundfont: SoundFont):
+        self._id = next(_PLAYER_IDS)
+        self._soundfont = soundfont
+        pcm = np.frombuffer(soundfont.sample_data, dtype="<i2")
+        self._frames = pcm.astype(np.float32) / 2**15
+        self._frames.setflags(write=False)
+        self._zones: Dict[Tuple[int, int], List[SoundFontZone]] = dict()
+        phdr = soundfont.pdta[b"phdr"]
+        for i in range(len(phdr) - 1):
+            preset = (int(phdr["bank"][i]), int(phdr["preset"][i]))
+            self._zones[preset] = self._get_preset_zones(i)
+
+    def get_zones(
+        self, bank: int, program: int, key: int, velocity: int
+    ) -> List[SoundFontZone]:
+        return [
+            zone
+            for zone in self._zones.get((bank, program), list())
+            if zone.plays(key, velocity)
+        ]
+
+    def get_note_length(
+        self,
+        bank: int,
+        program: int,
+        key: int,
+        velocity: int,
+        num_frames: int,
+        sample_rate: int,
+    ) -> int:
+        """
+        Returns the number of frames of a note held for `num_frames` frames, including its release, without rendering it.
+        """
+        return max(
+            (
+                _get_voice_length(zone, key, num_frames, sample_rate)
+                for zone in self.get_zones(bank, program, key, velocity)
+            ),
+            default=0,
+        )
+
+    def get_note_waveform(
+        self,
+        bank: int,
+        program: int,
+        key: int,
+        velocity: int,
+        num_frames: int,
+        sample_rate: int,
+    ) -> NDArray[np.float32]:
+        """
+        Renders a note held for `num_frames` frames, followed by its release. Waveforms are cached, and are read-only.
+        """
+        cache_key = (self._id, bank, program, key, velocity, num_frames, sample_rate)
+
+        def render() -> NDArray[np.float32]:
+            voices = [
+                self._render_voice(zone, key, num_frames, sample_rate)
+                for zone in self.get_zones(bank, program, key, velocity)
+            ]
+            waveform = np.zeros(
+                max((len(v) for v in voices), default=0), dtype=np.float32
+            )
+            for voice in voices:
+                waveform[: len(voice)] += voice
+            waveform *= _GAIN * (velocity / 127) ** 2
+            waveform.setflags(write=False)
+            return waveform
+
+        return _NOTE_WAVEFORM_CACHE.get_or_create(cache_key, render)
+
+    def _get_preset_zones(self, preset: int) -> List[SoundFontZone]:
+        pdta = self._soundfont.pdta
+        zones: List[SoundFontZone] = list()
+        for preset_gens in _get_zone_gens(
+            pdta[b"phdr"], pdta[b"pbag"], pdta[b"pgen"], preset, _GEN_INSTRUMENT
+        ):
+            instrument = preset_gens[_GEN_INSTRUMENT]
+            for instrument_gens in _get_zone_gens(
+                pdta[b"inst"], pdta[b"ibag"], pdta[b"igen"], instrument, _GEN_SAMPLE_ID
+            ):
+                gens = {**_GEN_DEFAULTS, **instrument_gens}
+                for gen, amount in preset_gens.items():
+                    if gen not in _GEN_NOT_ADDITIVE:
+                        gens[gen] = gens.get(gen, 0) + amount
+                key_range = _intersect(
+                    gens[_GEN_KEY_RANGE], preset_gens.get(_GEN_KEY_RANGE)
+                )
+                velocity_range = _intersect(
+                    gens[_GEN_VELOCITY_RANGE], preset_gens.get(_GEN_VELOCITY_RANGE)
+                )
+                if (
+                    key_range[0] <= key_range[1]
+                    and velocity_range[0] <= velocity_range[1]
+                ):
+                    zones.append(self._create_zone(gens, key_range, velocity_range))
+        return zones
+
+    def _create_zone(
+        self,
+        gens: Dict[int, int],
+        key_range: Tuple[int, int],
+        velocity_range: Tuple[int, int],
+    ) -> SoundFontZone:
+        header = self._soundfont.pdta[b"shdr"][gens[_GEN_SAMPLE_ID]]
+
+        def get_offset(fine: int, coarse: int) -> int:
+            return gens.get(fine, 0) + 32768 * gens.get(coarse, 0)
+
+        def get_seconds(gen: int) -> float:
+            return 2 ** (gens[gen] / 1200)
+
+        root_key = gens[_GEN_ROOT_KEY]
+        return SoundFontZone(
+            key_range=key_range,
+            velocity_range=velocity_range,
+            sample_index=gens[_GEN_SAMPLE_ID],
+            start=int(header["start"])
+            + get_offset(_GEN_START_OFFSET, _GEN_START_COARSE_OFFSET),
+            end=int(header["end"])
+            + get_offset(_GEN_END_OFFSET, _GEN_END_COARSE_OFFSET),
+            loop_start=int(header["loop_start"])
+            + get_offset(_GEN_LOOP_START_OFFSET, _GEN_LOOP_START_COARSE_OFFSET),
+            loop_end=int(header["loop_end"])
+            + get_offset(_GEN_LOOP_END_OFFSET, _GEN_LOOP_END_COARSE_OFFSET),
+            loops=gens.get(_GEN_SAMPLE_MODES, 0) & 1 == 1,
+            sample_rate=int(header["sample_rate"]),
+            root_key=root_key if root_key >= 0 else int(header["pitch"]),
+            tuning=100 * gens.get(_GEN_COARSE_TUNE, 0)
+            + gens.get(_GEN_FINE_TUNE, 0)
+            + int(header["pitch_correction"]),
+            scale_tuning=gens[_GEN_SCALE_TUNING],
+            attenuation=max(gens.get(_GEN_ATTENUATION, 0), 0),
+            pan=min(max(gens.get(_GEN_PAN, 0), -500), 500),
+            envelope=(
+                get_seconds(_GEN_DELAY),
+                get_seconds(_GEN_ATTACK),
+                get_seconds(_GEN_HOLD),
+                get_seconds(_GEN_DECAY),
+                get_seconds(_GEN_RELEASE),
+                min(max(gens.get(_GEN_SUSTAIN, 0), 0), 1440),
+            ),
+        )
+
+    def _render_voice(
+        self,
+        zone: SoundFontZone,
+        key: int,
+        num_frames: int,
+        sample_rate: int,
+    ) -> NDArray[np.float32]:
+        envelope = _get_envelope(zone, num_frames, sample_rate)
+        length = _get_voice_length(zone, key, num_frames, sample_rate)
+        positions = zone.start + np.arange(length) * _get_step(zone, key, sample_rate)
+        if _loops(zone):
+            loop_length = zone.loop_end - zone.loop_start
+            looped = positions >= zone.loop_end
+            positions[looped] = (
+                zone.loop_start + (positions[looped] - zone.loop_start) % loop_length
+            )
+
+        # Linear interpolation between neighbouring frames.
+        indices = np.minimum(positions.astype(np.int64), len(self._frames) - 1)
+        fractions = (positions - indices).astype(np.float32)
+        frames = self._frames
+        voice = frames[indices] * (1 - fractions)
+        voice += frames[np.minimum(indices + 1, len(frames) - 1)] * fractions
+
+        # The mean of the left and right gains of FluidSynth's pan law, since the output is downmixed to mono.
+        angle = np.pi / 2 * (zone.pan + 500) / 1000
+        gain = 10 ** (-zone.attenuation / 200) * (np.cos(angle) + np.sin(angle)) / 2
+        voice *= envelope[: len(voice)] * np.float32(gain)
+        return voice
+
+
+@memoize("soundfont_player.players", maxsize=4)
+def load_soundfont_player(path: str) -> SoundFontPlayer:
+    """
+    Loads the sample zones of an SF2 file once per path.
+    """
+    return SoundFontPlayer(read_soundfont(path))
+
+
+def _get_zone_gens(
+    headers: NDArray[np.void],
+    bags: NDArray[np.void],
+    gens: NDArray[np.void],
+    index: int,
+    terminal_oper: int,
+) -> List[Dict[int, int]]:
+    """
+    Returns the generators of each zone of a preset or instrument, with the generators of its global zone as defaults.
+
+    :param terminal_oper: The generator that ends every local zone: the instrument of preset zones, or the sample of instrument zones.
+    """
+    global_gens: Dict[int, int] = dict()
+    zones: List[Dict[int, int]] = list()
+    for bag in range(int(headers["bag"][index]), int(headers["bag"][index + 1])):
+        records = gens[int(bags["gen"][bag]) : int(bags["gen"][bag + 1])]
+        zone = {
+            int(oper): int(amount)
+            for oper, amount in zip(records["oper"], records["amount"].astype(np.int16))
+        }
+        if terminal_oper in zone:
+            zone[terminal_oper] = zone[terminal_oper] & 0xFFFF
+            zones.append({**global_gens, **zone})
+        elif len(zones) == 0:
+            global_gens = zone
+    return zones
+
+
+def _intersect(range_amount: int, other_amount: int | None) -> Tuple[int, int]:
+    low, high = range_amount & 0xFF, (range_amount >> 8) & 0xFF
+    if other_amount is not None:
+        low, high = max(low, other_amount & 0xFF), min(high, (other_amount >> 8) & 0xFF)
+    return (low, high)
+
+
+def _loops(zone: SoundFontZone) -> bool:
+    return zone.loops and zone.loop_start < zone.loop_end
+
+
+def _get_step(zone: SoundFontZone, key: int, sample_rate: int) -> float:
+    """
+    Returns the number of sample frames played per output frame.
+    """
+    cents = (key - zone.root_key) * zone.scale_tuning + zone.tuning
+    return 2 ** (cents / 1200) * zone.sample_rate / sample_rate
+
+
+def _get_voice_length(
+    zone: SoundFontZone,
+    key: int,
+    num_frames: int,
+    sample_rate: int,
+) -> int:
+    """
+    Returns the number of frames of a voice: its envelope, cut short where a sample without a loop runs out.
+    """
+    length = num_frames + _get_release_length(zone, num_frames, sample_rate)
+    if not _loops(zone):
+        step = _get_step(zone, key, sample_rate)
+        length = min(length, max(math.ceil((zone.end - 1 - zone.start) / step), 0))
+    return length
+
+
+def _get_end_attenuation(
+    zone: SoundFontZone,
+    num_frames: int,
+    sample_rate: int,
+) -> float:
+    """
+    Returns the attenuation of the decay in centibels at the last held frame.
+    """
+    if num_frames == 0:
+        return 0
+    delay, attack, hold, decay, _, sustain = zone.envelope
+    time = (num_frames - 1) / sample_rate
+    return min(max((time - delay - attack - hold) * _SILENCE_CB / decay, 0), sustain)
+
+
+def _get_release_length(
+    zone: SoundFontZone,
+    num_frames: int,
+    sample_rate: int,
+) -> int:
+    release = zone.envelope[4]
+    end_attenuation = _get_end_attenuation(zone, num_frames, sample_rate)
+    return int(
+        max(_SILENCE_CB - end_attenuation, 0) / _SILENCE_CB * release * sample_rate
+    )
+
+
+def _get_envelope(
+    zone: SoundFontZone,
+    num_frames: int,
+    sample_rate: int,
+) -> NDArray[np.float32]:
+    """
+    Returns the amplitude of the volume envelope of a note held for `num_frames` frames, followed by its release.
+
+    The attack rises linearly. The decay and release fall linearly in centibels, at 960 centibels per decay or release time.
+    """
+    delay, attack, hold, decay, release, sustain = zone.envelope
+    times = np.arange(num_frames) / sample_rate
+    attenuation = np.clip(
+        (times - delay - attack - hold) * _SILENCE_CB / decay, 0, sustain
+    )
+    held = 10 ** (-attenuation / 200)
+    held = np.where(
+        times < delay + attack, np.clip((times - delay) / attack, 0, 1), held
+    )
+
+    release_times = (
+        np.arange(_get_release_length(zone, num_frames, sample_rate)) / sample_rate
+    )
+    level = float(held[-1]) if num_frames > 0 else 0
+    released = level * 10 ** (-(release_times * _SILENCE_CB / release) / 200)
+    return np.concatenate([held, released]).astype(np.float32)
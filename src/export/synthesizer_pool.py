@@ -0,0 +1,213 @@
+import ctypes
+import ctypes.util
+import queue
+import threading
+import numpy as np
+from typing import Dict, Iterator, Tuple
+from numpy.typing import NDArray
+
+from logger import LOGGER
+
+
+_FLUID_FAILED = -1
+_FLUID_PLAYER_PLAYING = 1
+_BLOCK_SIZE = 4096  # frames rendered per call into the synthesizer
+
+
+def _load_library() -> ctypes.CDLL | None:
+    path = ctypes.util.find_library("fluidsynth")
+    if path is None:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+
+    def declare(name: str, restype: object, *argtypes: object):
+        function = getattr(lib, name)
+        function.restype = restype
+        function.argtypes = argtypes
+
+    p, i, s, d = ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_double
+    declare("new_fluid_settings", p)
+    declare("delete_fluid_settings", None, p)
+    declare("fluid_settings_setnum", i, p, s, d)
+    declare("fluid_settings_setint", i, p, s, i)
+    declare("fluid_settings_setstr", i, p, s, s)
+    declare("new_fluid_synth", p, p)
+    declare("delete_fluid_synth", None, p)
+    declare("fluid_synth_sfload", i, p, s, i)
+    declare("fluid_synth_sfcount", i, p)
+    declare("fluid_synth_system_reset", i, p)
+    declare("fluid_synth_write_float", i, p, i, p, i, i, p, i, i)
+    declare("new_fluid_player", p, p)
+    declare("delete_fluid_player", None, p)
+    declare("fluid_player_add_mem", i, p, p, ctypes.c_size_t)
+    declare("fluid_player_play", i, p)
+    declare("fluid_player_stop", i, p)
+    declare("fluid_player_get_status", i, p)
+    return lib
+
+
+class SynthesizerError(Exception):
+    pass
+
+
+class Synthesizer:
+    """
+    An in-process FluidSynth instance with a soundfont loaded once at creation.
+
+    :param lib: The FluidSynth library.
+    :param soundfont_path: The soundfont to load.
+    :param sample_rate: The sample rate to render at.
+    """
+
+    def __init__(self, lib: ctypes.CDLL, soundfont_path: str, sample_rate: int):
+        self._lib = lib
+        self._settings = lib.new_fluid_settings()
+        # Drive MIDI playback from the rendered samples instead of the system clock.
+        lib.fluid_settings_setstr(self._settings, b"player.timing-source", b"sample")
+        lib.fluid_settings_setint(self._settings, b"synth.lock-memory", 0)
+        lib.fluid_settings_setnum(self._settings, b"synth.sample-rate", sample_rate)
+        self._synth = lib.new_fluid_synth(self._settings)
+        if not self._synth:
+            lib.delete_fluid_settings(self._settings)
+            raise SynthesizerError("Failed to create a FluidSynth synthesizer.")
+        if (
+            lib.fluid_synth_sfload(self._synth, soundfont_path.encode(), 1)
+            == _FLUID_FAILED
+        ):
+            self.close()
+            raise SynthesizerError(f"Failed to load {soundfont_path}.")
+
+    def is_healthy(self) -> bool:
+        return (
+            self._synth is not None and self._lib.fluid_synth_sfcount(self._synth) > 0
+        )
+
+    def stream(self, midi: bytes) -> Iterator[NDArray[np.float32]]:
+        """
+        Renders a standard MIDI file to blocks of interleaved stereo frames.
+        """
+        lib = self._lib
+        player = lib.new_fluid_player(self._synth)
+        if not player:
+            raise SynthesizerError("Failed to create a FluidSynth player.")
+        try:
+            if lib.fluid_player_add_mem(player, midi, len(midi)) == _FLUID_FAILED:
+                raise SynthesizerError("Failed to load the MIDI data.")
+            lib.fluid_player_play(player)
+            while lib.fluid_player_get_status(player) == _FLUID_PLAYER_PLAYING:
+                block = np.empty(_BLOCK_SIZE * 2, dtype=np.float32)
+                address = block.ctypes.data
+                status = lib.fluid_synth_write_float(
+                    self._synth, _BLOCK_SIZE, address, 0, 2, address, 1, 2
+                )
+                if status == _FLUID_FAILED:
+                    raise SynthesizerError("Failed to render the MIDI data.")
+                yield block
+            lib.fluid_player_stop(player)
+        finally:
+            lib.delete_fluid_player(player)
+            # Silence voices left over from this render.
+            lib.fluid_synth_system_reset(self._synth)
+
+    def close(self):
+        if self._synth is not None:
+            self._lib.delete_fluid_synth(self._synth)
+            self._synth = None
+        if self._settings is not None:
+            self._lib.delete_fluid_settings(self._settings)
+            self._settings = None
+
+
+class SynthesizerPool:
+    """
+    A pool of long-lived synthesizers per soundfont and sample rate, so each soundfont is loaded once per synthesizer instead of once per render.
+
+    Synthesizers are created on demand, up to the pool size. A synthesizer that fails a health check or a render is replaced by a new one.
+    """
+
+    def __init__(self, size: int = 1):
+        self._lib = _load_library()
+        self._size = size
+        self._lock = threading.Lock()
+        self._idle: Dict[Tuple[str, int], "queue.Queue[Synthesizer]"] = dict()
+        self._num_created: Dict[Tuple[str, int], int] = dict()
+
+    def configure(self, size: int):
+        assert size > 0
+        self._size = size
+
+    @property
+    def is_available(self) -> bool:
+        """
+        Whether the FluidSynth library could be loaded.
+        """
+        return self._lib is not None
+
+    def warm_up(self, soundfont_path: str, sample_rate: int):
+        """
+        Creates every synthesizer of the pool for a soundfont and sample rate.
+        """
+        synthesizers = [
+            self._acquire(soundfont_path, sample_rate) for _ in range(self._size)
+        ]
+        for synthesizer in synthesizers:
+            self._release(soundfont_path, sample_rate, synthesizer)
+
+    def stream(
+        self,
+        midi: bytes,
+        soundfont_path: str,
+        sample_rate: int,
+    ) -> Iterator[NDArray[np.float32]]:
+        """
+        Renders a standard MIDI file to blocks of interleaved stereo frames on an idle synthesizer, waiting for one if needed. The synthesizer is held until the blocks are exhausted or closed, and is restarted if the render fails.
+        """
+        synthesizer = self._acquire(soundfont_path, sample_rate)
+        failed = False
+        try:
+            yield from synthesizer.stream(midi)
+        except SynthesizerError:
+            LOGGER.warning("Synthesizer failed to render. Restarting it.")
+            failed = True
+            self._discard(soundfont_path, sample_rate, synthesizer)
+            raise
+        finally:
+            if not failed:
+                self._release(soundfont_path, sample_rate, synthesizer)
+
+    def _acquire(self, soundfont_path: str, sample_rate: int) -> Synthesizer:
+        assert self._lib is not None
+        key = (soundfont_path, sample_rate)
+        with self._lock:
+            idle = self._idle.setdefault(key, queue.Queue())
+            create = idle.empty() and self._num_created.get(key, 0) < self._size
+            if create:
+                self._num_created[key] = self._num_created.get(key, 0) + 1
+        if create:
+            try:
+                return Synthesizer(self._lib, soundfont_path, sample_rate)
+            except BaseException:
+                with self._lock:
+                    self._num_created[key] -= 1
+                raise
+        synthesizer = idle.get()
+        if not synthesizer.is_healthy():
+            LOGGER.warning("Synthesizer failed its health check. Restarting it.")
+            # Free the slot first, so a replacement that fails to start does not leak it.
+            self._discard(soundfont_path, sample_rate, synthesizer)
+            return self._acquire(soundfont_path, sample_rate)
+        return synthesizer
+
+    def _release(self, soundfont_path: str, sample_rate: int, synthesizer: Synthesizer):
+        self._idle[(soundfont_path, sample_rate)].put(synthesizer)
+
+    def _discard(self, soundfont_path: str, sample_rate: int, synthesizer: Synthesizer):
+        synthesizer.close()
+        with self._lock:
+            self._num_created[(soundfont_path, sample_rate)] -= 1
+
+
+SYNTHESIZER_POOL = SynthesizerPool()
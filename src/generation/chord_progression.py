@@ -1,8 +1,11 @@
+import numpy as np
 from dataclasses import dataclass
 from typing import Dict, Tuple, List, FrozenSet
-from functools import cached_property
+from numpy.typing import NDArray
 
-from common.structures.chord import Chord
+from common.cache import memoized_property
+from common.structures.chord import Chord, ChordQuality
+from common.structures.pitch import Pitch
 
 
 @dataclass(frozen=True)
@@ -30,7 +33,7 @@ class ChordProgression:
     def end_time(self) -> int:
         return self._end_time
 
-    @cached_property
+    @memoized_property("chord_progression.chords")
     def chords(self) -> List[ChordAtTime]:
         sorted_chords = sorted(self._chords.items(), key=lambda x: x[0])
         return [
@@ -72,8 +75,33 @@ class ChordProgression:
                 ret.append(chord_at_time.chord)
         return frozenset(ret)
 
+    def to_arrays(self) -> Dict[str, NDArray[np.generic]]:
+        """
+        Returns the time range, and the start time, root and quality name of each chord.
+        """
+        items = sorted(self._chords.items(), key=lambda x: x[0])
+        return {
+            "time_range": np.array([self.start_time, self.end_time], dtype=np.int32),
+            "times": np.array([time for time, _ in items], dtype=np.int32),
+            "roots": np.array([chord.root.value for _, chord in items], dtype=np.int32),
+            "qualities": np.array(
+                [chord.quality.name for _, chord in items], dtype=str
+            ),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, NDArray[np.generic]]) -> "ChordProgression":
+        start_time, end_time = arrays["time_range"]
+        chord_progression = cls(int(start_time), int(end_time))
+        chord_progression.add_chords(
+            *[
+                (Chord(Pitch(int(root)), ChordQuality[str(quality)]), int(time))
+                for time, root, quality in zip(
+                    arrays["times"], arrays["roots"], arrays["qualities"]
+                )
+            ]
+        )
+        return chord_progression
+
     def _clear_chords_cache(self):
-        try:
-            del self.chords
-        except:
-            pass
+        memoized_property.invalidate(self, "chords")
@@ -10,7 +10,7 @@ from instruments.base import (
 )
 
 from export.arrangement import ArrangementMetadata
-from export.part import MIDIPart
+from export.part import PercussionPart
 
 
 BASS_DRUM_PITCH = Pitch(35)
@@ -34,16 +34,15 @@ class BassDrum(MIDIInstrument):
         melody: NoteCollection,
         chord_progression: ChordProgression,
         arrangement_metadata: ArrangementMetadata,
-    ) -> MIDIPart:
-        notes = NoteCollection()
-        end = max([note.end for note in melody.list()])
+    ) -> PercussionPart:
+        pattern = NoteCollection()
+        pattern.add(
+            Note(pitch=BASS_DRUM_PITCH, start=0, duration=4),
+        )
 
-        measure = 0
-        while arrangement_metadata.Time(measure, 0) < end:
-            time = arrangement_metadata.Time(measure, 0)
-            notes.add(
-                Note(pitch=BASS_DRUM_PITCH, start=time, duration=4),
-            )
-            measure += 1
+        end = max([note.end for note in melody.list()])
+        num_measures = 0
+        while arrangement_metadata.Time(num_measures, 0) < end:
+            num_measures += 1
 
-        return MIDIPart(arrangement_metadata, self, notes)
+        return PercussionPart(arrangement_metadata, self, pattern, num_measures)
@@ -10,7 +10,7 @@ from instruments.base import (
 )
 
 from export.arrangement import ArrangementMetadata
-from export.part import MIDIPart
+from export.part import PercussionPart
 
 SNARE_DRUM_PITCH = Pitch(38)
 
@@ -33,18 +33,19 @@ class SnareDrum(MIDIInstrument):
         melody: NoteCollection,
         chord_progression: ChordProgression,
         arrangement_metadata: ArrangementMetadata,
-    ) -> MIDIPart:
-        notes = NoteCollection()
+    ) -> PercussionPart:
+        pattern = NoteCollection()
+        for beat in range(arrangement_metadata.beats_per_measure):
+            time = arrangement_metadata.Time(0, beat)
+            pattern.add(
+                Note(pitch=SNARE_DRUM_PITCH, start=time, duration=2),
+                Note(pitch=SNARE_DRUM_PITCH, start=time + 2, duration=1),
+                Note(pitch=SNARE_DRUM_PITCH, start=time + 3, duration=1),
+            )
+
         end = max([note.end for note in melody.list()])
+        num_measures = 0
+        while arrangement_metadata.Time(num_measures, 0) < end:
+            num_measures += 1
 
-        measure = 0
-        while arrangement_metadata.Time(measure, 0) < end:
-            for beat in range(arrangement_metadata.beats_per_measure):
-                time = arrangement_metadata.Time(measure, beat)
-                notes.add(
-                    Note(pitch=SNARE_DRUM_PITCH, start=time, duration=2),
-                    Note(pitch=SNARE_DRUM_PITCH, start=time + 2, duration=1),
-                    Note(pitch=SNARE_DRUM_PITCH, start=time + 3, duration=1),
-                )
-            measure += 1
-        return MIDIPart(arrangement_metadata, self, notes)
+        return PercussionPart(arrangement_metadata, self, pattern, num_measures)
@@ -0,0 +1,43 @@
+import time
+import sqlite3
+import argparse
+
+from logger import LOGGER
+from env import get_env, create_env_dirs
+from jobs import get_job_queue, get_worker_id, run_job
+from worker_pool import initialize_worker
+
+
+def run_worker(poll_interval: float = 1):
+    """
+    Runs the jobs of the job queue one at a time, until interrupted. Any number of workers can share a queue.
+
+    :param poll_interval: The number of seconds to wait before checking an empty queue again.
+    """
+    create_env_dirs(get_env())
+    initialize_worker()
+    queue = get_job_queue()
+    worker_id = get_worker_id()
+    LOGGER.info(f"Worker {worker_id} is polling for jobs.")
+    while True:
+        try:
+            job = queue.claim(worker_id)
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_job(queue, job, worker_id)
+        except sqlite3.Error:
+            # Such as a locked database. A job left running is claimed again once its lease expires.
+            LOGGER.exception(f"Worker {worker_id} failed to access the job queue.")
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs queued generation jobs.")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1,
+        help="seconds to wait before checking an empty queue again",
+    )
+    run_worker(parser.parse_args().poll_interval)
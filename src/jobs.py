@@ -0,0 +1,337 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import threading
+import contextlib
+from dataclasses import dataclass, fields
+from functools import cache
+from typing import Any, Iterator, List, Literal, Optional, Set
+
+import main
+from logger import LOGGER
+from env import get_env
+from worker_pool import WORKER_POOL
+from export.audio_encoder import AudioEncoding
+
+
+JobStatus = Literal["queued", "running", "succeeded", "failed"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    input_path TEXT NOT NULL,
+    encoding TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    output_path TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at);
+"""
+# The number of seconds to wait for another process to release the database.
+_BUSY_TIMEOUT = 30
+_POLL_INTERVAL = 1  # in seconds
+_ERROR_BACKOFF = 5  # in seconds
+
+
+@dataclass
+class Job:
+    """
+    :param stage: The timed stage of the pipeline being run, or that failed.
+    :param progress: The fraction of the stages of the pipeline that have finished.
+    :param error: The error of the last failed attempt.
+    :param output_path: The arrangement of a succeeded job.
+    :param attempts: The number of times the job was claimed by a worker.
+    """
+
+    id: str
+    input_path: str
+    encoding: AudioEncoding
+    status: JobStatus = "queued"
+    stage: Optional[str] = None
+    progress: float = 0
+    error: Optional[str] = None
+    output_path: Optional[str] = None
+    attempts: int = 0
+
+
+_JOB_COLUMNS = ", ".join(field.name for field in fields(Job))
+
+
+class JobQueue:
+    """
+    A durable queue of generation jobs in a SQLite database. Every process that opens the same file shares the queue, so workers in several processes or containers on a shared volume can run its jobs.
+
+    A worker claims a job with a lease that it renews with heartbeats while it runs the job. A job whose worker fails or stops renewing the lease is queued again, until it has been attempted `max_attempts` times.
+
+    :param path: The SQLite database.
+    :param lease_duration: The number of seconds a claim or heartbeat holds a job for.
+    :param max_attempts: The number of times a job is claimed before it fails for good.
+    """
+
+    def __init__(self, path: str, lease_duration: float = 60, max_attempts: int = 3):
+        self._path = path
+        self.lease_duration = lease_duration
+        self._max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def submit(self, input_path: str, encoding: AudioEncoding) -> Job:
+        job = Job(str(uuid.uuid4()), input_path, encoding)
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, input_path, encoding, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job.id, job.input_path, job.encoding, job.status, now, now),
+            )
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._connect() as connection:
+            row = connection.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return None if row is None else Job(*row)
+
+    def claim(self, worker_id: str) -> Optional[Job]:
+        """
+        Leases the oldest queued job, or the oldest job whose lease expired, to a worker.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, worker_id = NULL, lease_expires_at = NULL, updated_at = ? WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                ("The worker stopped running the job.", now, now, self._max_attempts),
+            )
+            row = connection.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires_at < ?) ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'running', stage = NULL, progress = 0, attempts = attempts + 1, worker_id = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (worker_id, now + self.lease_duration, now, row[0]),
+            )
+            job = Job(
+                *connection.execute(
+                    f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", row
+                ).fetchone()
+            )
+        LOGGER.info(f"Worker {worker_id} claimed job {job.id}.")
+        return job
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """
+        Renews the lease of a worker on a job. Returns whether the worker still holds the job.
+        """
+        now = time.time()
+        return self._update_claimed(
+            job_id,
+            worker_id,
+            "lease_expires_at = ?",
+            now + self.lease_duration,
+        )
+
+    def update_stage(self, job_id: str, worker_id: str, stage: str, progress: float):
+        self._update_claimed(
+            job_id, worker_id, "stage = ?, progress = ?", stage, progress
+        )
+
+    def complete(self, job_id: str, worker_id: str, output_path: str) -> bool:
+        return self._update_claimed(
+            job_id,
+            worker_id,
+            "status = 'succeeded', stage = NULL, progress = 1, output_path = ?, worker_id = NULL, lease_expires_at = NULL",
+            output_path,
+        )
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """
+        Queues a job again after a failed attempt, or fails it for good after its last attempt.
+        """
+        return self._update_claimed(
+            job_id,
+            worker_id,
+            "status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, error = ?, worker_id = NULL, lease_expires_at = NULL",
+            self._max_attempts,
+            error,
+        )
+
+    def _update_claimed(
+        self, job_id: str, worker_id: str, assignments: str, *values: Any
+    ) -> bool:
+        """
+        Updates a job only if the worker still holds it, so a worker whose lease expired cannot overwrite the job's next attempt.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+                (*values, time.time(), job_id, worker_id),
+            )
+            return cursor.rowcount > 0
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(
+            self._path, timeout=_BUSY_TIMEOUT, isolation_level=None
+        )
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as connection:
+            # Take the write lock up front, so two workers cannot claim the same job.
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+
+@cache
+def get_job_queue() -> JobQueue:
+    """
+    Opens the job queue of the environment on first call.
+    """
+    env = get_env()
+    return JobQueue(env.JOB_DATABASE or os.path.join(env.OUTPUT_DIR, "jobs.sqlite3"))
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@contextlib.contextmanager
+def hold_lease(queue: JobQueue, job: Job, worker_id: str) -> Iterator[None]:
+    """
+    Sends heartbeats for a job from a background thread until the context exits.
+    """
+    stopped = threading.Event()
+
+    def send_heartbeats():
+        while not stopped.wait(queue.lease_duration / 3):
+            try:
+                held = queue.heartbeat(job.id, worker_id)
+            except sqlite3.Error:
+                # Such as a locked database. The next heartbeat renews the lease if it has not expired yet.
+                LOGGER.exception(f"Worker {worker_id} failed to renew its lease.")
+                continue
+            if not held and not stopped.is_set():
+                LOGGER.warning(f"Worker {worker_id} lost its lease on job {job.id}.")
+                return
+
+    heartbeat = threading.Thread(target=send_heartbeats, daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        # The thread is not joined, since it may be waiting on the database. A heartbeat sent after the job completes or fails matches no running job.
+        stopped.set()
+
+
+def get_stage_listener(queue: JobQueue, job: Job, worker_id: str) -> main.StageListener:
+    """
+    Returns a listener that records the stage and progress of a job.
+    """
+    finished_stages: Set[str] = set()
+
+    def update_stage(label: str, finished: bool):
+        if finished:
+            finished_stages.add(label)
+        progress = len(finished_stages) / len(main.STAGES)
+        try:
+            queue.update_stage(job.id, worker_id, label, progress)
+        except sqlite3.Error:
+            # The progress is only reported, so a locked database does not fail the job.
+            LOGGER.exception(f"Failed to record the progress of job {job.id}.")
+
+    return update_stage
+
+
+def run_job(queue: JobQueue, job: Job, worker_id: str):
+    """
+    Runs a claimed job in this process.
+    """
+    with hold_lease(queue, job, worker_id):
+        try:
+            with main.listen_to_stages(get_stage_listener(queue, job, worker_id)):
+                output_path = main.generate(job.input_path, job.encoding)
+        except Exception as e:
+            LOGGER.exception(f"Job {job.id} failed.")
+            queue.fail(job.id, worker_id, repr(e))
+        else:
+            queue.complete(job.id, worker_id, output_path)
+
+
+class JobConsumers:
+    """
+    Runs the jobs of a queue in the worker pool of the server. The queue is only accessed from threads, since the database may be locked by another process.
+    """
+
+    def __init__(self):
+        self._consumers: List[asyncio.Task[None]] = list()
+
+    def start(self, queue: JobQueue, num_consumers: int):
+        assert num_consumers > 0
+        self._consumers = [
+            asyncio.create_task(self._consume(queue)) for _ in range(num_consumers)
+        ]
+
+    async def stop(self):
+        # Jobs left running are claimed again once their leases expire.
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = list()
+
+    async def _consume(self, queue: JobQueue):
+        worker_id = get_worker_id()
+        while True:
+            try:
+                if not await self._consume_one(queue, worker_id):
+                    await asyncio.sleep(_POLL_INTERVAL)
+            except Exception:
+                # Such as a locked database. A job left running is claimed again once its lease expires.
+                LOGGER.exception(f"Worker {worker_id} failed to access the job queue.")
+                await asyncio.sleep(_ERROR_BACKOFF)
+
+    async def _consume_one(self, queue: JobQueue, worker_id: str) -> bool:
+        """
+        Runs the next job of the queue. Returns whether there was a job to run.
+        """
+        job = await asyncio.to_thread(queue.claim, worker_id)
+        if job is None:
+            return False
+        with hold_lease(queue, job, worker_id):
+            try:
+                output_path = await WORKER_POOL.run_with_stages(
+                    get_stage_listener(queue, job, worker_id),
+                    main.generate,
+                    job.input_path,
+                    job.encoding,
+                )
+            except Exception as e:
+                LOGGER.exception(f"Job {job.id} failed.")
+                await asyncio.to_thread(queue.fail, job.id, worker_id, repr(e))
+            else:
+                await asyncio.to_thread(queue.complete, job.id, worker_id, output_path)
+        return True
+
+
+JOB_CONSUMERS = JobConsumers()
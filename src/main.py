@@ -1,16 +1,24 @@
 import os
 import time
-from typing import Callable, Any
+import uuid
+import hashlib
+import contextlib
+import numpy as np
+from typing import Callable, Any, Dict, Iterator, List, Tuple, Type, TypeVar
+from numpy.typing import NDArray
 
 from logger import LOGGER
-from env import ENV
+from env import get_env
 
+from artifacts import get_artifact_store
+from common.cache import get_cache_stats
 from common.note_collection import NoteCollection
 
 from melody_extraction.signal import SignalMelodyExtractor
 
 from generation.chord_progression import ChordProgression
 from generation.viterbi import ViterbiChordProgressionGenerator
+from instruments.base import Instrument
 from instruments.voice_melody import VoiceMelody
 from instruments.voice_harmony import VoiceHarmony
 from instruments.piano import Piano
@@ -18,9 +26,57 @@ from instruments.bass_drum import BassDrum
 from instruments.snare_drum import SnareDrum
 
 from export.arrangement import Arrangement, ArrangementExportConfig, ArrangementMetadata
+from export.audio_encoder import AUDIO_ENCODINGS, AudioEncoding, encode_stream
 from export.arrangement_generator import ArrangementGenerator
 
 
+T = TypeVar("T")
+
+INSTRUMENTS: List[Tuple[str, Type[Instrument]]] = [
+    ("Voice 1", VoiceMelody),
+    ("Voice 2", VoiceHarmony),
+    ("Piano", Piano),
+    ("Bass Drum", BassDrum),
+    ("Snare Drum", SnareDrum),
+]
+
+# MVP assumptions.
+ARRANGEMENT_METADATA = ArrangementMetadata(
+    beats_per_minute=110,
+    time_signature=(4, 4),
+    quantization=16,
+)
+
+# Bump when a change to the pipeline changes its output, so arrangements cached by `get_input_key` are generated again.
+ENGINE_VERSION = 1
+
+
+# The labels of the timed stages of `generate`, in order.
+STAGES: Tuple[str, ...] = (
+    "melody extraction",
+    "chord generation",
+    "arrangement generation",
+    "audio export",
+)
+
+# Called with the label of a timed stage and whether the stage has finished.
+StageListener = Callable[[str, bool], None]
+
+_STAGE_LISTENERS: List[StageListener] = list()
+
+
+@contextlib.contextmanager
+def listen_to_stages(listener: StageListener) -> Iterator[None]:
+    """
+    Calls `listener` when each timed stage starts and finishes, until the context exits.
+    """
+    _STAGE_LISTENERS.append(listener)
+    try:
+        yield
+    finally:
+        _STAGE_LISTENERS.remove(listener)
+
+
 def timed(label: str) -> Any:
     capitalized_label = label[0].upper() + label[1:]
 
@@ -28,9 +84,13 @@ def timed(label: str) -> Any:
         def wrapper(*args: Any, **kwargs: Any) -> Any:
             time_stamp = time.time()
             LOGGER.info(f"Starting {label}...")
+            for listener in _STAGE_LISTENERS:
+                listener(label, False)
             ret = function(*args, **kwargs)
             elapsed_time = time.time() - time_stamp
             LOGGER.info(f"{capitalized_label} completed in {elapsed_time} seconds!")
+            for listener in _STAGE_LISTENERS:
+                listener(label, True)
             return ret
 
         return wrapper
@@ -38,6 +98,13 @@ def timed(label: str) -> Any:
     return decorator
 
 
+def log_cache_stats():
+    for name, stats in get_cache_stats().items():
+        LOGGER.info(
+            f"Cache {name}: {stats.hits} hits, {stats.misses} misses, {stats.evictions} evictions ({stats.hit_rate:.0%} hit rate)."
+        )
+
+
 @timed("melody extraction")
 def extract_melody(
     input_path: str,
@@ -70,34 +137,176 @@ def generate_arrangement(
         chord_progression,
         arrangement_metadata,
     )
-    arrangement_generator.add_instrument("Voice 1", VoiceMelody)
-    arrangement_generator.add_instrument("Voice 2", VoiceHarmony)
-    arrangement_generator.add_instrument("Piano", Piano)
-    arrangement_generator.add_instrument("Bass Drum", BassDrum)
-    arrangement_generator.add_instrument("Snare Drum", SnareDrum)
+    for name, instrument_cls in INSTRUMENTS:
+        arrangement_generator.add_instrument(name, instrument_cls)
     return arrangement_generator.generate()
 
 
 @timed("audio export")
-def export_audio(output_path: str, arrangement: Arrangement):
-    arrangement.export(ArrangementExportConfig(output_path))
+def export_audio(
+    output_path: str,
+    arrangement: Arrangement,
+    encoding: AudioEncoding = "wav",
+):
+    arrangement.export(get_export_config(output_path, encoding))
+
+
+def stream_audio(arrangement: Arrangement, encoding: AudioEncoding) -> Iterator[bytes]:
+    """
+    Yields the encoded arrangement as it is mixed.
+    """
+    time_stamp = time.time()
+    LOGGER.info("Starting audio streaming...")
+    config = get_export_config("", encoding)
+    yield from encode_stream(arrangement.render(config), encoding, config.sample_rate)
+    elapsed_time = time.time() - time_stamp
+    LOGGER.info(f"Audio streaming completed in {elapsed_time} seconds!")
+    log_cache_stats()
 
 
-async def generate(input_path: str) -> str:
+def get_export_config(
+    output_path: str, encoding: AudioEncoding
+) -> ArrangementExportConfig:
+    return ArrangementExportConfig(
+        output_path,
+        midi_renderer=get_env().MIDI_RENDERER,  # type: ignore
+        encoding=encoding,
+    )
 
-    name = os.path.splitext(os.path.basename(input_path))[0]
-    output_path = os.path.join(ENV.OUTPUT_DIR, f"{name}.wav")
 
-    # MVP assumptions.
-    arrangement_metadata = ArrangementMetadata(
-        beats_per_minute=110,
-        time_signature=(4, 4),
-        quantization=16,
+def get_input_key(content: bytes, encoding: AudioEncoding) -> str:
+    """
+    Returns a hash of an input and of everything else that determines its arrangement.
+    """
+    return _hash(
+        content,
+        ENGINE_VERSION,
+        ARRANGEMENT_METADATA,
+        _get_instrument_names(),
+        get_export_config("", encoding),
+        # Compact sample storage changes the rendered audio.
+        get_env().SAMPLE_STORAGE,
     )
 
-    melody = extract_melody(input_path, arrangement_metadata)
-    chord_progression = generate_chords(melody, arrangement_metadata)
-    arrangement = generate_arrangement(melody, chord_progression, arrangement_metadata)
-    export_audio(output_path, arrangement)
+
+def get_output_path(input_path: str, encoding: AudioEncoding) -> str:
+    """
+    Returns the path of the arrangement of an input, named by the key of the input, so an arrangement is only reused for the same content and settings.
+    """
+    with open(input_path, "rb") as fin:
+        key = get_input_key(fin.read(), encoding)
+    extension = AUDIO_ENCODINGS[encoding].extension
+    return os.path.join(get_env().OUTPUT_DIR, f"{key}{extension}")
+
+
+def arrange(input_path: str) -> Arrangement:
+    """
+    Runs the stages before the export. A stage is skipped if its output for the same inputs was persisted, so changing a later stage does not redo the earlier ones.
+    """
+    with open(input_path, "rb") as fin:
+        melody_key = _hash(fin.read(), ENGINE_VERSION, ARRANGEMENT_METADATA)
+    melody = run_stage(
+        "melody extraction",
+        melody_key,
+        lambda: extract_melody(input_path, ARRANGEMENT_METADATA),
+        lambda melody: {"notes": melody.to_array()},
+        lambda arrays: NoteCollection.from_array(arrays["notes"]),  # type: ignore
+    )
+
+    chords_key = _hash(melody_key.encode())
+    chord_progression = run_stage(
+        "chord generation",
+        chords_key,
+        lambda: generate_chords(melody, ARRANGEMENT_METADATA),
+        ChordProgression.to_arrays,
+        ChordProgression.from_arrays,
+    )
+
+    arrangement_key = _hash(chords_key.encode(), _get_instrument_names())
+    return run_stage(
+        "arrangement generation",
+        arrangement_key,
+        lambda: generate_arrangement(melody, chord_progression, ARRANGEMENT_METADATA),
+        Arrangement.to_arrays,
+        lambda arrays: Arrangement.from_arrays(
+            ARRANGEMENT_METADATA,
+            [instrument_cls(name=name) for name, instrument_cls in INSTRUMENTS],
+            arrays,
+        ),
+    )
+
+
+def run_stage(
+    label: str,
+    key: str,
+    compute: Callable[[], T],
+    to_arrays: Callable[[T], Dict[str, NDArray[np.generic]]],
+    from_arrays: Callable[[Dict[str, NDArray[np.generic]]], T],
+) -> T:
+    """
+    Loads the output of a stage from the artifact store, or computes and persists it.
+
+    :param label: The label of the timed stage. Listeners are told the stage finished when it is loaded.
+    :param key: A hash of the inputs of the stage.
+    """
+    artifacts = get_artifact_store()
+    arrays = artifacts.load(label, key)
+    if arrays is not None:
+        LOGGER.info(f"Loaded {label} from artifact {key}.")
+        for listener in _STAGE_LISTENERS:
+            listener(label, True)
+        return from_arrays(arrays)
+
+    value = compute()
+    artifacts.save(label, key, to_arrays(value))
+    return value
+
+
+def generate(input_path: str, encoding: AudioEncoding = "wav") -> str:
+    """
+    Arranges the input into `OUTPUT_DIR`, unless the same content was already arranged with the same settings.
+    """
+
+    env = get_env()
+    os.makedirs(env.OUTPUT_DIR, exist_ok=True)
+
+    output_path = get_output_path(input_path, encoding)
+    if os.path.exists(output_path):
+        LOGGER.info(f"Reusing {output_path}.")
+        return output_path
+
+    arrangement = arrange(input_path)
+    # Export next to the output and rename it, so an interrupted export is never reused. Every export has its own partial file, since other processes may be exporting the same output.
+    partial_path = f"{output_path}.{uuid.uuid4()}.part"
+    try:
+        export_audio(partial_path, arrangement, encoding)
+        if os.path.exists(output_path):
+            LOGGER.info(f"Reusing {output_path}, exported concurrently.")
+        else:
+            os.replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    log_cache_stats()
 
     return output_path
+
+
+def generate_stream(
+    input_path: str, encoding: AudioEncoding = "wav"
+) -> Iterator[bytes]:
+    """
+    Arranges the input, and returns the encoded arrangement as an iterator that mixes it while it is read, so the audio can be sent before the export finishes.
+    """
+    arrangement = arrange(input_path)
+    return stream_audio(arrangement, encoding)
+
+
+def _get_instrument_names() -> List[Tuple[str, str]]:
+    return [(name, f"{cls.__module__}.{cls.__qualname__}") for name, cls in INSTRUMENTS]
+
+
+def _hash(content: bytes, *settings: Any) -> str:
+    digest = hashlib.sha256(content)
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
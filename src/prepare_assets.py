@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import urllib.request
+from typing import Set, Tuple
+
+from instruments.base import MIDIInstrument
+from export.arrangement import ArrangementExportConfig
+from export.soundfont import (
+    get_midi_preset,
+    read_soundfont,
+    subset_soundfont,
+    write_soundfont,
+)
+
+from main import INSTRUMENTS
+from build_sample_banks import build_sample_banks
+
+
+SOURCE_SOUNDFONT_URL = "https://github.com/musescore/MuseScore/raw/refs/heads/master/share/sound/MS%20Basic.sf3"
+
+
+def get_midi_presets() -> Set[Tuple[int, int]]:
+    """
+    Returns the bank and program of every preset played by the MIDI instruments of an arrangement.
+    """
+    presets: Set[Tuple[int, int]] = set()
+    for name, instrument_cls in INSTRUMENTS:
+        instrument = instrument_cls(name=name)
+        if isinstance(instrument, MIDIInstrument):
+            config = instrument.export_config
+            presets.add(get_midi_preset(config.instrument_id, config.channel))
+    return presets
+
+
+def build_soundfont(source_path: str | None = None):
+    """
+    Builds the soundfont used for export from the presets of the MIDI instruments.
+
+    :param source_path: The SF2 or SF3 soundfont to take the presets from. Downloads the MuseScore soundfont if not set.
+    """
+    config = ArrangementExportConfig(output_path="")
+    presets = get_midi_presets()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if source_path is None:
+            source_path = os.path.join(temp_dir, "source.sf3")
+            urllib.request.urlretrieve(SOURCE_SOUNDFONT_URL, source_path)
+        soundfont = subset_soundfont(read_soundfont(source_path), presets)
+    write_soundfont(config.soundfont_path, soundfont)
+    print(f"Built {config.soundfont_path} with presets {sorted(presets)}.")
+
+
+def prepare_assets(soundfont_source_path: str | None = None):
+    build_sample_banks()
+    build_soundfont(soundfont_source_path)
+
+
+if __name__ == "__main__":
+    prepare_assets(sys.argv[1] if len(sys.argv) > 1 else None)
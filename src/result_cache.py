@@ -0,0 +1,53 @@
+import os
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+import main
+from logger import LOGGER
+from export.audio_encoder import AudioEncoding
+
+
+class ResultCache:
+    """
+    Serves arrangements from `OUTPUT_DIR`, named by `main.get_output_path`, and generates each missing arrangement once. Concurrent requests for an arrangement being generated wait for the same generation.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future[str]] = dict()
+
+    def get(self, input_path: str, encoding: AudioEncoding) -> str | None:
+        """
+        Returns the path of an arrangement that was already generated.
+        """
+        output_path = main.get_output_path(input_path, encoding)
+        if os.path.exists(output_path):
+            LOGGER.info(f"Serving cached {output_path}.")
+            return output_path
+        return None
+
+    async def get_or_generate(
+        self,
+        input_path: str,
+        encoding: AudioEncoding,
+        generate: Callable[[], Awaitable[str]],
+    ) -> str:
+        """
+        Returns the path of the arrangement, awaiting `generate` if it is not cached or being generated.
+        """
+        output_path = self.get(input_path, encoding)
+        if output_path is not None:
+            return output_path
+
+        key = main.get_output_path(input_path, encoding)
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(generate())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key))
+        else:
+            LOGGER.info(f"Waiting for the generation of {key}.")
+        # A cancelled request must not cancel the generation for the others.
+        return await asyncio.shield(future)
+
+
+RESULT_CACHE = ResultCache()
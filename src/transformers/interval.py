@@ -1,5 +1,6 @@
 import re
-from functools import cache
+
+from common.cache import memoize
 
 
 class IntervalTransformer:
@@ -10,7 +11,7 @@ class IntervalTransformer:
             step = 2 if step == "W" else 1
             self.major_scale_intervals[i + 2] = self.major_scale_intervals[i + 1] + step
 
-    @cache
+    @memoize("interval_transformer.from_str", maxsize=1024)
     def from_str(self, input: str) -> int:
         regex = r"^([#b]*)(\d+)$"  # structure: accidental (optional), size
         match = re.search(regex, input)
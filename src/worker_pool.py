@@ -0,0 +1,325 @@
+import os
+import time
+import queue
+import asyncio
+import functools
+import contextlib
+import multiprocessing
+import threading
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.managers import SyncManager
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from common.audio_sample import AUDIO_SAMPLE_LIBRARY
+from export.arrangement import ArrangementExportConfig
+from export.synthesizer_pool import SYNTHESIZER_POOL
+
+import main
+from logger import LOGGER
+from env import get_env
+
+
+T = TypeVar("T")
+
+_STREAM_QUEUE_SIZE = 16  # chunks buffered between a worker and the response
+# A worker stops streaming to a reader that stalls for this many seconds.
+_STREAM_TIMEOUT = 60
+_POLL_INTERVAL = 1  # in seconds
+# The number of threads relaying the items of calls per worker: one for the call running on the worker, and one for a call waiting for it.
+_RELAYS_PER_WORKER = 2
+
+
+class _StreamClosed(Exception):
+    pass
+
+
+class WorkerPool:
+    """
+    Runs the generation pipeline in worker processes, so it does not block the event loop and requests are generated in parallel.
+
+    Each worker loads the audio sample library and the synthesizers once, when it starts. Workers are started with `start`, and all of them are warmed up at once. If a worker dies, the calls running in the pool fail and the pool is started again.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager: Optional[SyncManager] = None
+        # Waits for the items workers put, so the polls do not hold the threads of the default executor.
+        self._relay: Optional[ThreadPoolExecutor] = None
+        self._warm_ups: List[concurrent.futures.Future[None]] = list()
+        self._size = 0
+
+    def start(self, size: int):
+        assert self._executor is None
+        assert size > 0
+        self._size = size
+        # Forking would copy the locks of the server's threads.
+        context = multiprocessing.get_context("spawn")
+        self._manager = context.Manager()
+        self._relay = ThreadPoolExecutor(
+            max_workers=size * _RELAYS_PER_WORKER,
+            thread_name_prefix="worker-relay",
+        )
+        self._executor = ProcessPoolExecutor(
+            max_workers=size,
+            mp_context=context,
+            initializer=initialize_worker,
+        )
+        # Every submission without an idle worker starts a worker, which warms up before it runs the submission. No warm-up returns until all of them run, so each one occupies a different worker.
+        barrier = self._manager.Barrier(size)
+        self._warm_ups = [
+            self._executor.submit(_wait_for_workers, barrier) for _ in range(size)
+        ]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        if self._relay is not None:
+            self._relay.shutdown(wait=False, cancel_futures=True)
+            self._relay = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def is_ready(self) -> bool:
+        """
+        Whether every worker has warmed up.
+        """
+        return len(self._warm_ups) > 0 and all(
+            future.done() and future.exception() is None for future in self._warm_ups
+        )
+
+    def wait_until_ready(self):
+        concurrent.futures.wait(self._warm_ups)
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """
+        Calls a function in a worker. The function and its arguments must be picklable.
+        """
+        assert self._executor is not None
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        with self._restart_if_broken(executor):
+            return await loop.run_in_executor(executor, function, *args)
+
+    async def run_with_stages(
+        self,
+        listener: main.StageListener,
+        function: Callable[..., T],
+        *args: Any,
+    ) -> T:
+        """
+        Calls a function in a worker like `run`, and calls `listener` in a thread of this process as the worker starts and finishes each timed stage, so a slow listener does not block the event loop.
+        """
+        assert self._executor is not None and self._manager is not None
+        assert self._relay is not None
+        loop = asyncio.get_running_loop()
+        executor, relay = self._executor, self._relay
+        with self._restart_if_broken(executor):
+            events = self._manager.Queue()
+            future = loop.run_in_executor(
+                executor, _run_with_stages, events, function, *args
+            )
+            while (event := await _get_item(relay, events, future)) is not None:
+                await asyncio.to_thread(listener, *event)
+            return await future
+
+    async def stream(
+        self,
+        function: Callable[..., Iterator[bytes]],
+        *args: Any,
+    ) -> AsyncIterator[bytes]:
+        """
+        Calls a function that returns an iterator in a worker, and returns the items of the iterator as the worker produces them. Errors raised by the function itself are raised here, and errors raised while iterating end the iteration. Closing the returned iterator stops the worker.
+        """
+        assert self._executor is not None and self._manager is not None
+        assert self._relay is not None
+        loop = asyncio.get_running_loop()
+        executor, relay = self._executor, self._relay
+        with self._restart_if_broken(executor):
+            chunks = self._manager.Queue(maxsize=_STREAM_QUEUE_SIZE)
+            closed = self._manager.Event()
+            future = loop.run_in_executor(
+                executor, _put_chunks, chunks, closed, function, *args
+            )
+            chunk_stream = _ChunkStream(self, executor, relay, chunks, closed, future)
+            try:
+                if await _get_item(relay, chunks, future) is None:
+                    await future  # raises the error of the function
+            except BaseException:
+                await chunk_stream.aclose()
+                raise
+        return chunk_stream
+
+    @contextlib.contextmanager
+    def _restart_if_broken(self, executor: ProcessPoolExecutor) -> Iterator[None]:
+        """
+        Starts the pool again if a worker of `executor` dies in the context. A dead worker breaks every call running in the pool, so only the first call to see the error restarts it.
+        """
+        try:
+            yield
+        except BrokenProcessPool:
+            if self._executor is executor:
+                LOGGER.error("A worker died. Restarting the worker pool.")
+                self.shutdown()
+                self.start(self._size)
+            raise
+
+
+class _ChunkStream:
+    """
+    The chunks a worker streams. Closing the stream, or cancelling a read, stops the worker, even if no chunk was read.
+    """
+
+    def __init__(
+        self,
+        pool: WorkerPool,
+        executor: ProcessPoolExecutor,
+        relay: ThreadPoolExecutor,
+        chunks: "queue.Queue[Optional[bytes]]",
+        closed: threading.Event,
+        future: "asyncio.Future[None]",
+    ):
+        self._pool = pool
+        self._executor = executor
+        self._relay = relay
+        self._chunks = chunks
+        self._closed = closed
+        self._future = future
+
+    def __aiter__(self) -> "_ChunkStream":
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            with self._pool._restart_if_broken(self._executor):
+                chunk = await _get_item(self._relay, self._chunks, self._future)
+                if chunk is None:
+                    await self._future
+                    raise StopAsyncIteration
+                return chunk
+        except BaseException:
+            self._close()
+            raise
+
+    async def aclose(self):
+        self._close()
+
+    def _close(self):
+        if not self._future.done():
+            # Set without awaiting, since the stream may be closed by a cancelled task.
+            with contextlib.suppress(OSError, EOFError):
+                self._closed.set()
+            self._future.cancel()
+
+
+async def _get_item(
+    relay: ThreadPoolExecutor,
+    items: "queue.Queue[Optional[T]]",
+    future: "asyncio.Future[Any]",
+) -> Optional[T]:
+    """
+    Gets the next item a worker puts, or `None` once the worker puts `None` or finishes without putting it.
+    """
+    loop = asyncio.get_running_loop()
+    get = functools.partial(items.get, timeout=_POLL_INTERVAL)
+    while True:
+        try:
+            return await loop.run_in_executor(relay, get)
+        except queue.Empty:
+            if future.done():
+                # The worker died before it could put `None`.
+                await future
+                return None
+
+
+def initialize_worker():
+    """
+    Configures and loads the audio sample library and the synthesizers of this process.
+    """
+    env = get_env()
+    AUDIO_SAMPLE_LIBRARY.configure(
+        lazy=env.LAZY_SAMPLE_LOADING,
+        storage=env.SAMPLE_STORAGE,  # type: ignore
+    )
+    SYNTHESIZER_POOL.configure(size=env.SYNTH_POOL_SIZE)
+    AUDIO_SAMPLE_LIBRARY.load_all()
+    config = ArrangementExportConfig(output_path="")
+    if SYNTHESIZER_POOL.is_available and os.path.exists(config.soundfont_path):
+        SYNTHESIZER_POOL.warm_up(config.soundfont_path, config.sample_rate)
+    LOGGER.info(f"Worker {os.getpid()} is ready.")
+
+
+def _wait_for_workers(barrier: threading.Barrier):
+    barrier.wait()
+
+
+def _run_with_stages(
+    events: "queue.Queue[Optional[Tuple[str, bool]]]",
+    function: Callable[..., T],
+    *args: Any,
+) -> T:
+    def put_event(label: str, finished: bool):
+        events.put((label, finished))
+
+    try:
+        with main.listen_to_stages(put_event):
+            return function(*args)
+    finally:
+        events.put(None)
+
+
+def _put_chunks(
+    chunks: "queue.Queue[Optional[bytes]]",
+    closed: threading.Event,
+    function: Callable[..., Iterator[bytes]],
+    *args: Any,
+):
+    """
+    Puts an empty chunk once the function returns, then the items of its iterator, then `None`. Stops once the reader closes the stream.
+    """
+    try:
+        iterator = function(*args)
+        _put_chunk(chunks, closed, b"")
+        with contextlib.closing(iterator):  # type: ignore
+            for chunk in iterator:
+                _put_chunk(chunks, closed, chunk)
+    except _StreamClosed:
+        return
+    finally:
+        if not closed.is_set():
+            with contextlib.suppress(queue.Full):
+                chunks.put(None, timeout=_STREAM_TIMEOUT)
+
+
+def _put_chunk(
+    chunks: "queue.Queue[Optional[bytes]]",
+    closed: threading.Event,
+    chunk: bytes,
+):
+    """
+    Puts a chunk, checking every poll interval whether the reader closed the stream. Raises `queue.Full` if the reader stalls for `_STREAM_TIMEOUT` seconds.
+    """
+    deadline = time.monotonic() + _STREAM_TIMEOUT
+    while not closed.is_set():
+        try:
+            chunks.put(chunk, timeout=_POLL_INTERVAL)
+            return
+        except queue.Full:
+            if time.monotonic() > deadline:
+                raise
+    raise _StreamClosed()
+
+
+WORKER_POOL = WorkerPool()